@@ -11,14 +11,25 @@ from trading import EdgarParams, Scheduler
 async def main(loop, logger, today):
     try:
         params = EdgarParams()
+        params.Layout = os.environ['STORAGE_LAYOUT'] if 'STORAGE_LAYOUT' in os.environ else 'STREAM'
+        params.StartYear = os.environ['START_YEAR'] if 'START_YEAR' in os.environ else ''
+        params.CacheSnapshot = os.environ['CACHE_SNAPSHOT'] if 'CACHE_SNAPSHOT' in os.environ else 'CACHE'
+        params.CacheLookback = int(os.environ['CACHE_LOOKBACK']) if 'CACHE_LOOKBACK' in os.environ else 0
+        params.Analytics = os.environ['ANALYTICS_BACKEND'] if 'ANALYTICS_BACKEND' in os.environ else 'DYNAMODB'
+        params.AnalyticsPath = os.environ['ANALYTICS_DB'] if 'ANALYTICS_DB' in os.environ else '/tmp/insider/analytics.db'
         timeout = os.environ['TIMEOUT']
         arn = os.environ['TRN_ERROR_ARN']
         count = int(os.environ['TRN_COUNT'])
         notify = os.environ['TRN_NOTIFY']
+        rebuild = 'REBUILD_CACHE' in os.environ and os.environ['REBUILD_CACHE'] == 'TRUE'
 
+        profiler = utils.Profiler.FromEnvironment()
         async with Scheduler(notify, params, logger, loop) as scheduler:
-            scheduler.AnalyseThat(today, arn, count)
+            scheduler.AnalyseThat(today, arn, count, rebuild)
             logger.info('Analyse That Succeeded')
+        utils.Metrics.Report(logger, 'run', Date=today.strftime('%Y%m%d'))
+        if profiler is not None:
+            profiler.Report(logger, os.environ.get('PROFILE_PATH'))
 
     except Exception as e:
         logger.error(e)
@@ -1,5 +1,6 @@
 import pandas as pd
 from datetime import datetime, timedelta
+from utils import Metrics
 
 
 class DecisionEngine:
@@ -9,15 +10,17 @@ class DecisionEngine:
         self.__notify = notify
         self.__logger = logger
 
+    @Metrics.timed('analytics.ClusterBuying')
     def ClusterBuying(self, df, date, count, cik):
         # cleanse
         pd.options.mode.chained_assignment = None  # default='warn'
-        df['DATE'] = df['DATE'].str.strip()
-        df = df[df.DATE != '0000-00-00']
-        df['TYPE'] = df['TYPE'].str.strip()
-        # convert
-        df['NUMBER'] = pd.to_numeric(df['NUMBER'], errors='coerce')
-        df['DATE'] = pd.to_datetime(df['DATE'])
+        if not pd.api.types.is_datetime64_any_dtype(df['DATE']):
+            df['DATE'] = df['DATE'].str.strip()
+            df = df[df.DATE != '0000-00-00']
+            df['TYPE'] = df['TYPE'].str.strip()
+            # convert
+            df['NUMBER'] = pd.to_numeric(df['NUMBER'], errors='coerce')
+            df['DATE'] = pd.to_datetime(df['DATE'])
         df = df.sort_values(by='DATE')
         # group
         df = df[df['TYPE'] == 'P-Purchase']
@@ -43,3 +46,48 @@ class DecisionEngine:
         line = (cik, pLM, pBLM, pRatio, mLM, mBLM, mRatio)
         self.__logger.info('%s, %s, %s, %s, %s, %s, %s' % line)
         return line
+
+    @Metrics.timed('analytics.ClusterBuyingBatch')
+    def ClusterBuyingBatch(self, df, date, count):
+        # df holds the transactions of every CIK, keyed by the CIK column
+        pd.options.mode.chained_assignment = None  # default='warn'
+        all_cik = list(df['CIK'].drop_duplicates())
+        # cleanse, frames from the transaction cache are already typed
+        if not pd.api.types.is_datetime64_any_dtype(df['DATE']):
+            df['DATE'] = df['DATE'].str.strip()
+            df = df[df.DATE != '0000-00-00']
+            df['TYPE'] = df['TYPE'].str.strip()
+        # group
+        df = df[df['TYPE'] == 'P-Purchase']
+        # convert
+        if not pd.api.types.is_datetime64_any_dtype(df['DATE']):
+            df['NUMBER'] = pd.to_numeric(df['NUMBER'], errors='coerce')
+            df['DATE'] = pd.to_datetime(df['DATE'], errors='coerce')
+        # filter
+        first = date.replace(day=1)
+        lastMonth = first - timedelta(days=1)
+        fromDate = datetime(lastMonth.year, lastMonth.month, date.day)
+        df['LM'] = (df['DATE'] >= fromDate) & (df['DATE'] < date)
+        df['BLM'] = df['DATE'] < fromDate
+        dfLastMonth = df[df['LM']].groupby('CIK')
+        dfPriorMonths = df[df['BLM']].groupby('CIK')
+        pLMs = dfLastMonth['OWNER'].nunique().reindex(all_cik, fill_value=0)
+        mLMs = dfLastMonth['NUMBER'].sum().reindex(all_cik, fill_value=0)
+        pBLMs = dfPriorMonths['OWNER'].nunique().reindex(all_cik, fill_value=0)
+        mBLMs = dfPriorMonths['NUMBER'].sum().reindex(all_cik, fill_value=0)
+
+        lines = []
+        for cik in all_cik:
+            pLM = int(pLMs[cik])
+            mLM = mLMs[cik]
+            if pLM < count:
+                line = (cik, pLM, 0, 0, mLM, 0, 0)
+            else:
+                pBLM = int(pBLMs[cik])
+                mBLM = mBLMs[cik]
+                pRatio = round(pLM / pBLM if pBLM != 0 else pLM, 2)
+                mRatio = round(mLM / mBLM if mBLM != 0 else mLM, 2)
+                line = (cik, pLM, pBLM, pRatio, mLM, mBLM, mRatio)
+            self.__logger.info('%s, %s, %s, %s, %s, %s, %s' % line)
+            lines.append(line)
+        return lines
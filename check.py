@@ -12,6 +12,8 @@ from trading import EdgarParams, Scheduler
 async def main(loop, logger, today, fix):
     try:
         params = EdgarParams()
+        params.Analytics = os.environ['ANALYTICS_BACKEND'] if 'ANALYTICS_BACKEND' in os.environ else 'DYNAMODB'
+        params.AnalyticsPath = os.environ['ANALYTICS_DB'] if 'ANALYTICS_DB' in os.environ else '/tmp/insider/analytics.db'
         delay = float(os.environ['DELAY'])
         buffer = int(os.environ['BUFFER_SIZE'])
         found = os.environ['TRN_FOUND_ARN']
@@ -1,14 +1,28 @@
 import asyncio
 import boto3
-import io
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeDeserializer
 import json
-from utils import DecimalEncoder
+from utils import DecimalEncoder, Connection, ErrorType, Metrics
 from datetime import datetime, timedelta
 from botocore.exceptions import ClientError
 import pandas as pd
-import base64
+import numpy as np
+import binascii
+import codecs
+import decimal
+import functools
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import tarfile
+import threading
+import uuid
 import zlib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 class FileType(object):
     OWNER = 'OWNER'
@@ -19,6 +33,52 @@ class Period(object):
     DAY = 'DAY'
     MONTH = 'MONTH'
 
+    @staticmethod
+    def Range(date, period):
+        # TransactionTime bounds of the analytics of a day, or of the month up to that day
+        if period == Period.DAY:
+            start = datetime(date.year, date.month, date.day, 0, 0, 0, 1)
+            start = (start - datetime(1970, 1, 1)).total_seconds()
+            end = datetime(date.year, date.month, date.day, 23, 59, 59, 999999)
+            end = (end - datetime(1970, 1, 1)).total_seconds()
+        if period == Period.MONTH:
+            startDate = datetime(date.year, date.month, date.day, 0, 0, 0, 1)
+            end = (startDate - datetime(1970, 1, 1)).total_seconds()
+
+            first = startDate.replace(day=1)
+            lastMonth = first - timedelta(days=1)
+            endDate = datetime(lastMonth.year, lastMonth.month, date.day, 0, 0, 0, 1)
+            start = (endDate - datetime(1970, 1, 1)).total_seconds()
+        return start, end
+
+
+class Backend(object):
+    # where analytics, high-water marks and chunk claims are kept
+    DYNAMODB = 'DYNAMODB'
+    SQLITE = 'SQLITE'
+
+
+class Layout(object):
+    # STREAM: every CIK interleaved in the firehose objects, CORPS2019/05/...
+    # PARTITIONED: gzipped csv per CIK hash bucket and month of writing, PARTITIONS/CORPS/07/2019-05/...
+    STREAM = 'STREAM'
+    PARTITIONED = 'PARTITIONED'
+    ROOT = 'PARTITIONS'
+    BUCKETS = 32
+
+    @staticmethod
+    def Bucket(cik):
+        return zlib.crc32(str(int(cik)).encode()) % Layout.BUCKETS
+
+    @staticmethod
+    def Prefix(recordType, bucket):
+        return '%s/%s/%02d/' % (Layout.ROOT, recordType, bucket)
+
+    @staticmethod
+    def Key(recordType, bucket, date):
+        return '%s%04d-%02d/%s-%s.csv.gz' % (Layout.Prefix(recordType, bucket), date.year, date.month,
+                                            date.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex)
+
 
 def opener(filename, size=4):
     with open(filename, "rb") as f:
@@ -31,12 +91,917 @@ def opener(filename, size=4):
                 break
 
 
+def unpad(data):
+    # firehose records are base64 encoded one by one, so padding can appear in the middle of the data.
+    # decode every padded record with one call and keep the unaligned tail for the next chunk
+    end = len(data) - len(data) % 4
+    view = memoryview(data)
+    decoded = []
+    start = 0
+    pad = data.find(b'=', start, end)
+    while pad != -1:
+        stop = (pad // 4 + 1) * 4
+        decoded.append(binascii.a2b_base64(view[start:stop]))
+        start = stop
+        pad = data.find(b'=', start, end)
+    if start < end:
+        decoded.append(binascii.a2b_base64(view[start:end]))
+    return b''.join(decoded), data[end:]
+
+
+BASE64 = re.compile(b'^[A-Za-z0-9+/=]*$')
+
+
+def streamer(body, size=64 * 1024):
+    # older objects hold base64 records, newer ones the csv lines as they are. Base64 has no commas or newlines,
+    # so the first bytes of an object tell them apart
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = b''
+    text = ''
+    raw = None
+    chunk = body.read(size)
+    while chunk or decompressor.unconsumed_tail:
+        data = pending + decompressor.decompress(decompressor.unconsumed_tail or chunk, size)
+        if not decompressor.unconsumed_tail:
+            chunk = body.read(size)
+        if raw is None:
+            # a read can decompress to only a few bytes, hold them until there is enough to tell
+            if len(data) < 64 and b'\n' not in data and (chunk or decompressor.unconsumed_tail):
+                pending = data
+                continue
+            raw = BASE64.match(data[:64]) is None
+        if raw:
+            decoded, pending = data, b''
+        else:
+            decoded, pending = unpad(data)
+        lines = (text + decoder.decode(decoded)).split('\n')
+        text = lines.pop()
+        for line in lines:
+            yield line
+    rest = pending + decompressor.flush()
+    if raw is None:
+        raw = BASE64.match(rest[:64]) is None
+    decoded, pending = (rest, b'') if raw else unpad(rest)
+    text += decoder.decode(decoded, final=True)
+    for line in text.split('\n'):
+        yield line
+
+
+class TimeSeriesCache(object):
+    # one binary file per column and CIK, appended in place and memory-mapped on read
+    COLUMNS = [('KEY', 'u8'), ('DATE', 'M8[ns]'), ('NAME', 'i4'), ('TYPE', 'i4'), ('NUMBER', 'f8')]
+    CATEGORIES = ['NAME', 'TYPE']
+
+    def __init__(self, root):
+        self.__root = root
+
+    def __Folder(self, fileType, cik):
+        return os.path.join(self.__root, fileType, str(cik))
+
+    @staticmethod
+    def __Rows(folder):
+        sizes = [os.path.getsize(os.path.join(folder, '%s.bin' % name)) // np.dtype(dtype).itemsize
+                 if os.path.exists(os.path.join(folder, '%s.bin' % name)) else 0
+                 for name, dtype in TimeSeriesCache.COLUMNS]
+        return min(sizes)
+
+    @staticmethod
+    def __Categories(folder, name):
+        path = os.path.join(folder, '%s.json' % name)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def __Column(folder, name, dtype, rows):
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(folder, '%s.bin' % name), dtype=dtype, mode='r', shape=(rows,))
+
+    def Append(self, fileType, cik, lines):
+        # CIK,A/D,DATE,OWNER/ISSUER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,...
+        folder = self.__Folder(fileType, cik)
+        os.makedirs(folder, exist_ok=True)
+        rows = self.__Rows(folder)
+        known = set(self.__Column(folder, 'KEY', 'u8', rows).tolist())
+
+        keys, dates, names, types, numbers = [], [], [], [], []
+        for line in lines:
+            line = line.rstrip()
+            fields = line.split(',')
+            if len(fields) < 8:
+                continue
+            key = int.from_bytes(hashlib.blake2b(line.encode(), digest_size=8).digest(), 'little')
+            if key in known:
+                continue
+            known.add(key)
+            keys.append(key)
+            dates.append(fields[2].strip())
+            names.append(fields[3].strip())
+            types.append(fields[5].strip())
+            numbers.append(fields[7])
+        if len(keys) == 0:
+            return 0
+
+        columns = {
+            'KEY': np.array(keys, dtype='u8'),
+            'DATE': pd.to_datetime(pd.Series(dates), format='%Y-%m-%d', errors='coerce').values.astype('M8[ns]'),
+            'NUMBER': pd.to_numeric(pd.Series(numbers), errors='coerce').values.astype('f8')
+        }
+        for name, values in [('NAME', names), ('TYPE', types)]:
+            categories = self.__Categories(folder, name)
+            lookup = {category: code for code, category in enumerate(categories)}
+            codes = np.empty(len(values), dtype='i4')
+            for i, value in enumerate(values):
+                if value not in lookup:
+                    lookup[value] = len(categories)
+                    categories.append(value)
+                codes[i] = lookup[value]
+            columns[name] = codes
+            with open(os.path.join(folder, '%s.json.tmp' % name), 'w') as f:
+                json.dump(categories, f)
+            os.replace(os.path.join(folder, '%s.json.tmp' % name), os.path.join(folder, '%s.json' % name))
+
+        # drop whatever an interrupted append left behind so the columns stay aligned
+        for name, dtype in TimeSeriesCache.COLUMNS:
+            with open(os.path.join(folder, '%s.bin' % name), 'ab') as f:
+                f.truncate(rows * np.dtype(dtype).itemsize)
+                columns[name].tofile(f)
+        return len(keys)
+
+    def GetManifest(self, fileType):
+        path = os.path.join(self.__root, '%s.manifest.json' % fileType)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def SaveManifest(self, fileType, manifest):
+        os.makedirs(self.__root, exist_ok=True)
+        path = os.path.join(self.__root, '%s.manifest.json' % fileType)
+        with open('%s.tmp' % path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace('%s.tmp' % path, path)
+
+    def Clear(self, fileType):
+        shutil.rmtree(os.path.join(self.__root, fileType), ignore_errors=True)
+        self.SaveManifest(fileType, {})
+
+    def Pack(self, fileType, path):
+        # the columns of every CIK and the manifest of the objects they came from, in one archive
+        with tarfile.open(path, 'w:gz') as tar:
+            for name in [fileType, '%s.manifest.json' % fileType]:
+                if os.path.exists(os.path.join(self.__root, name)):
+                    tar.add(os.path.join(self.__root, name), arcname=name)
+
+    def Unpack(self, fileType, path):
+        self.Clear(fileType)
+        with tarfile.open(path, 'r:gz') as tar:
+            members = [member for member in tar.getmembers()
+                       if member.name == '%s.manifest.json' % fileType or member.name.startswith('%s/' % fileType)]
+            tar.extractall(self.__root, members=members)
+
+    def Read(self, fileType, cik):
+        folder = self.__Folder(fileType, cik)
+        rows = self.__Rows(folder)
+        if rows == 0:
+            raise FileNotFoundError('No cached transactions in %s' % folder)
+        name = 'OWNER' if fileType == FileType.ISSUER else 'ISSUER'
+        return pd.DataFrame({
+            'DATE': self.__Column(folder, 'DATE', 'M8[ns]', rows),
+            name: pd.Categorical.from_codes(self.__Column(folder, 'NAME', 'i4', rows),
+                                            self.__Categories(folder, 'NAME')),
+            'TYPE': pd.Categorical.from_codes(self.__Column(folder, 'TYPE', 'i4', rows),
+                                              self.__Categories(folder, 'TYPE')),
+            'NUMBER': self.__Column(folder, 'NUMBER', 'f8', rows)
+        }, copy=False)
+
+
+class HttpCache(object):
+    # one file per url body plus an index of validators, evicted least recently used first past the size bound
+    def __init__(self, root, size):
+        self.__root = root
+        self.__size = size
+        self.__index = OrderedDict()
+        self.__dirty = 0
+        path = os.path.join(self.__root, 'index.json')
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    for entry in json.load(f):
+                        if os.path.exists(self.__Path(entry['Url'])):
+                            self.__index[entry['Url']] = entry
+            except (ValueError, KeyError):
+                self.__index = OrderedDict()
+        self.__used = sum(entry['Size'] for entry in self.__index.values())
+
+    def __Path(self, url):
+        return os.path.join(self.__root, hashlib.sha1(url.encode()).hexdigest())
+
+    def Headers(self, url):
+        # conditional request headers for a cached url, empty when there is nothing to revalidate
+        entry = self.__index.get(url)
+        if entry is None:
+            return {}
+        headers = {}
+        if entry['ETag'] is not None:
+            headers['If-None-Match'] = entry['ETag']
+        if entry['Modified'] is not None:
+            headers['If-Modified-Since'] = entry['Modified']
+        return headers
+
+    def Load(self, url):
+        entry = self.__index.get(url)
+        if entry is None:
+            return None
+        try:
+            with open(self.__Path(url), 'r', encoding='utf-8') as f:
+                payload = f.read()
+        except OSError:
+            self.__Drop(url)
+            return None
+        self.__index.move_to_end(url)
+        return payload
+
+    def Put(self, url, etag, modified, payload):
+        if etag is None and modified is None:
+            return
+        body = payload.encode('utf-8')
+        if len(body) > self.__size:
+            return
+        os.makedirs(self.__root, exist_ok=True)
+        path = self.__Path(url)
+        with open('%s.tmp' % path, 'wb') as f:
+            f.write(body)
+        os.replace('%s.tmp' % path, path)
+        if url in self.__index:
+            self.__used -= self.__index.pop(url)['Size']
+        self.__index[url] = dict(Url=url, ETag=etag, Modified=modified, Size=len(body))
+        self.__used += len(body)
+        while self.__used > self.__size:
+            self.__Drop(next(iter(self.__index)))
+        self.__dirty += 1
+        if self.__dirty >= 100:
+            self.Save()
+
+    def __Drop(self, url):
+        entry = self.__index.pop(url)
+        self.__used -= entry['Size']
+        try:
+            os.remove(self.__Path(url))
+        except OSError:
+            pass
+
+    def Save(self):
+        # the index is written in lru order, so recency survives a restart
+        if not self.__index and not os.path.exists(self.__root):
+            return
+        os.makedirs(self.__root, exist_ok=True)
+        path = os.path.join(self.__root, 'index.json')
+        with open('%s.tmp' % path, 'w') as f:
+            json.dump(list(self.__index.values()), f)
+        os.replace('%s.tmp' % path, path)
+        self.__dirty = 0
+
+
+class FirehoseWriter(object):
+    """Packs csv lines into firehose records and sends them in batches from a background task."""
+
+    # service limits: 1000 KiB per record, 500 records and 4 MiB per put_record_batch
+    RECORD = 1000 * 1024
+    RECORDS = 500
+    BATCH = 4 * 1024 * 1024
+
+    def __init__(self, client, stream, logger, loop, interval=1.0, retries=5):
+        self.__client = client
+        self.__stream = stream
+        self.__logger = logger
+        self.__loop = loop
+        self.__interval = interval
+        self.__retries = retries
+        self.__records = deque()
+        self.__bytes = 0
+        self.__lines = []
+        self.__size = 0
+        self.__wake = asyncio.Event()
+        self.__lock = asyncio.Lock()
+        self.__task = None
+        self.__calls = 0
+        self.__sent = 0
+        # CIKs with lines that could not be delivered, so their high-water marks are kept back
+        self.Failed = set()
+
+    def Put(self, lines):
+        for line in lines:
+            data = line.encode()
+            if self.__size + len(data) > FirehoseWriter.RECORD and len(self.__lines) > 0:
+                self.__Seal()
+            self.__lines.append(data)
+            self.__size += len(data)
+        if len(self.__records) >= FirehoseWriter.RECORDS or self.__bytes >= FirehoseWriter.BATCH:
+            self.__wake.set()
+        if self.__task is None:
+            self.__task = self.__loop.create_task(self.__Run())
+
+    def __Seal(self):
+        if len(self.__lines) == 0:
+            return
+        record = b''.join(self.__lines)
+        self.__records.append(record)
+        self.__bytes += len(record)
+        self.__lines = []
+        self.__size = 0
+
+    def __Batch(self):
+        batch = []
+        size = 0
+        while self.__records and len(batch) < FirehoseWriter.RECORDS \
+                and size + len(self.__records[0]) <= FirehoseWriter.BATCH:
+            record = self.__records.popleft()
+            batch.append(record)
+            size += len(record)
+        self.__bytes -= size
+        return batch
+
+    async def __Run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.__wake.wait(), self.__interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__wake.clear()
+            await self.Flush()
+
+    async def Flush(self):
+        async with self.__lock:
+            self.__Seal()
+            while self.__records:
+                await self.__Send(self.__Batch())
+
+    async def __Send(self, batch):
+        tries = 0
+        while len(batch) > 0:
+            error = None
+            try:
+                self.__calls += 1
+                with Metrics.Timer('firehose.put_record_batch'):
+                    response = await self.__loop.run_in_executor(None, functools.partial(
+                        self.__client.put_record_batch, DeliveryStreamName=self.__stream,
+                        Records=[{'Data': record} for record in batch]))
+                # only the records that failed go round again
+                failed = [record for record, result in zip(batch, response['RequestResponses'])
+                          if 'ErrorCode' in result]
+                self.__sent += len(batch) - len(failed)
+                Metrics.Count('firehose.records', len(batch) - len(failed))
+                Metrics.Count('firehose.failed', len(failed))
+                if len(failed) > 0:
+                    error = ErrorType.THROTTLED
+                    self.__logger.warn('%s of %s records to %s failed: %s'
+                                       % (len(failed), len(batch), self.__stream,
+                                          set(result['ErrorCode'] for result in response['RequestResponses']
+                                              if 'ErrorCode' in result)))
+                batch = failed
+            except Exception as e:
+                error = ErrorType.SERVER
+                self.__logger.error(e)
+            if error is None or len(batch) == 0:
+                return
+            tries += 1
+            if tries > self.__retries:
+                for record in batch:
+                    self.Failed.update(line.partition(b',')[0].decode() for line in record.split(b'\n') if line)
+                self.__logger.error('Dropped %s records to %s after %s tries' % (len(batch), self.__stream, tries))
+                return
+            await asyncio.sleep(Connection.Backoff(tries, error))
+
+    async def Close(self):
+        await self.Flush()
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+        if self.__calls > 0:
+            self.__logger.info('Sent %s records to %s in %s calls' % (self.__sent, self.__stream, self.__calls))
+
+
+class PartitionWriter(object):
+    """Writes csv lines straight to S3 as one gzipped object per CIK hash bucket and flush, see Layout."""
+
+    # a bucket is written out early once this much is waiting for it
+    SIZE = 8 * 1024 * 1024
+
+    def __init__(self, client, recordType, logger, loop, retries=5):
+        self.__client = client
+        self.__recordType = recordType
+        self.__logger = logger
+        self.__loop = loop
+        self.__retries = retries
+        self.__buckets = {}
+        self.__sizes = {}
+        self.__pending = set()
+        self.__objects = 0
+        self.Failed = set()
+
+    def Put(self, lines):
+        for line in lines:
+            bucket = Layout.Bucket(line.partition(',')[0])
+            self.__buckets.setdefault(bucket, []).append(line.encode())
+            self.__sizes[bucket] = self.__sizes.get(bucket, 0) + len(line)
+            if self.__sizes[bucket] >= PartitionWriter.SIZE:
+                task = self.__loop.create_task(self.__Upload(bucket, self.__Take(bucket)))
+                self.__pending.add(task)
+                task.add_done_callback(self.__pending.discard)
+
+    def __Take(self, bucket):
+        lines = self.__buckets.pop(bucket)
+        self.__sizes.pop(bucket)
+        return lines
+
+    async def __Upload(self, bucket, lines):
+        key = Layout.Key(self.__recordType, bucket, datetime.utcnow())
+        body = gzip.compress(b''.join(lines))
+        tries = 0
+        while True:
+            try:
+                with Metrics.Timer('partition.put_object'):
+                    await self.__loop.run_in_executor(None, functools.partial(
+                        self.__client.put_object, Bucket='chaos-insider', Key=key, Body=body))
+                self.__objects += 1
+                Metrics.Count('partition.bytes', len(body))
+                return
+            except Exception as e:
+                self.__logger.error(e)
+            tries += 1
+            if tries > self.__retries:
+                self.Failed.update(line.partition(b',')[0].decode() for line in lines)
+                self.__logger.error('Dropped %s lines to %s after %s tries' % (len(lines), key, tries))
+                return
+            await asyncio.sleep(Connection.Backoff(tries, ErrorType.SERVER))
+
+    async def Flush(self):
+        uploads = [self.__Upload(bucket, self.__Take(bucket)) for bucket in list(self.__buckets)]
+        await asyncio.gather(*(uploads + list(self.__pending)))
+
+    async def Close(self):
+        await self.Flush()
+        if self.__objects > 0:
+            self.__logger.info('Wrote %s %s partition objects' % (self.__objects, self.__recordType))
+
+
+class DynamoAnalytics(object):
+    # analytics, high-water marks and chunk claims in the Insiders.Analytics table
+    def __init__(self, logger):
+        self.__logger = logger
+        self.__deserializer = TypeDeserializer()
+        self.__dynamo = boto3.resource('dynamodb', region_name='us-east-1')
+        self.__Analytics = self.__dynamo.Table('Insiders.Analytics')
+        self.__client = boto3.client('dynamodb', region_name='us-east-1')
+
+    def Close(self):
+        pass
+
+    def GetMarks(self, fileType, ciks):
+        # high-water marks live next to the analytics, AnalyticId MARK.<type> and the CIK as TransactionTime
+        marks = {}
+        try:
+            keys = [{'AnalyticId': 'MARK.%s' % fileType, 'TransactionTime': str(cik)} for cik in ciks]
+            for i in range(0, len(keys), 100):
+                request = {'Insiders.Analytics': {'Keys': keys[i:i + 100]}}
+                while request:
+                    response = self.__dynamo.batch_get_item(RequestItems=request)
+                    for item in response['Responses'].get('Insiders.Analytics', []):
+                        marks[item['TransactionTime']] = {'Date': item['Date'], 'Keys': item['Keys']}
+                    request = response.get('UnprocessedKeys')
+        except ClientError as e:
+            self.__logger.error(e.response['Error']['Message'])
+        except Exception as e:
+            self.__logger.error(e)
+        return marks
+
+    def SaveMarks(self, fileType, marks):
+        try:
+            with self.__Analytics.batch_writer(overwrite_by_pkeys=['AnalyticId', 'TransactionTime']) as batch:
+                for cik, mark in marks.items():
+                    batch.put_item(Item={'AnalyticId': 'MARK.%s' % fileType, 'TransactionTime': str(cik),
+                                         'Date': mark['Date'], 'Keys': mark['Keys']})
+            self.__logger.info('Saved %s high-water marks for %s' % (len(marks), fileType))
+        except ClientError as e:
+            self.__logger.error(e.response['Error']['Message'])
+        except Exception as e:
+            self.__logger.error(e)
+
+    def GetAnalytics(self, analytic, date, period, projection=None, segments=1):
+        # every page of the query, only the projected attributes (dotted paths like Message.Processed work), and
+        # the time range split into segments that are queried in parallel
+        try:
+            self.__logger.info('Calling GetAnalytics query ...')
+            start, end = Period.Range(date, period)
+
+            step = (end - start) / segments
+            bounds = [(str(start + i * step), str(start + (i + 1) * step) if i < segments - 1 else str(end))
+                      for i in range(segments)]
+            if segments == 1:
+                parts = [self.__Query(analytic, bounds[0][0], bounds[0][1], projection)]
+            else:
+                with ThreadPoolExecutor(max_workers=segments) as executor:
+                    parts = list(executor.map(lambda bound: self.__Query(analytic, bound[0], bound[1], projection),
+                                              bounds))
+        except ClientError as e:
+            self.__logger.error(e.response['Error']['Message'])
+            return None
+        except Exception as e:
+            self.__logger.error(e)
+            return None
+        else:
+            # between is inclusive on both ends, so an item right on a segment boundary comes back twice
+            items = {}
+            for part in parts:
+                for item in part:
+                    items[item.get('TransactionTime', len(items))] = item
+            return list(items.values())
+
+    def __Query(self, analytic, start, end, projection):
+        names = {'#k': 'AnalyticId', '#t': 'TransactionTime'}
+        request = {
+            'TableName': 'Insiders.Analytics',
+            'KeyConditionExpression': '#k = :k AND #t BETWEEN :s AND :e',
+            'ExpressionAttributeValues': {':k': {'S': analytic}, ':s': {'S': start}, ':e': {'S': end}}
+        }
+        if projection is not None:
+            paths = []
+            for path in ['TransactionTime'] + projection:
+                parts = []
+                for name in path.split('.'):
+                    alias = '#p%s' % len(names)
+                    names[alias] = name
+                    parts.append(alias)
+                paths.append('.'.join(parts))
+            request['ProjectionExpression'] = ', '.join(paths)
+        request['ExpressionAttributeNames'] = names
+
+        # the low level client is thread safe, the table resource is not
+        items = []
+        while True:
+            response = self.__client.query(**request)
+            items.extend(dict((key, self.__deserializer.deserialize(value)) for key, value in item.items())
+                         for item in response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return items
+            request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def UpdateAnalytics(self, action, time, processed):
+        try:
+
+            response = self.__Analytics.update_item(
+                Key={
+                    'AnalyticId': action,
+                    'TransactionTime': time,
+                },
+                UpdateExpression="set #p = :p",
+                ExpressionAttributeNames={
+                    '#p': 'Processed'
+
+                },
+                ExpressionAttributeValues={
+                    ':p': processed
+                },
+                ReturnValues="UPDATED_NEW")
+
+        except ClientError as e:
+            self.__logger.error(e.response['Error']['Message'])
+        except Exception as e:
+            self.__logger.error(e)
+        else:
+            self.__logger.info('Analytics Updated')
+            self.__logger.info(json.dumps(response, indent=4, cls=DecimalEncoder))
+
+    def SaveAnalytics(self, action, description, message, today, count, requestId, chunks):
+        try:
+            # date = datetime.strptime(today, '%Y%m%d')
+            currentTime = datetime.now().time()
+            todayWithCurrentTime = datetime.combine(today, currentTime)
+            key = (todayWithCurrentTime - datetime(1970, 1, 1)).total_seconds()
+            # datetime.fromtimestamp(key)
+
+            response = self.__Analytics.update_item(
+                Key={
+                    'AnalyticId': action,
+                    'TransactionTime': str(key),
+                },
+                UpdateExpression="set #desc = :desc, #m = :m, #d = :d, #c = :c, #r = :r, #ch = :ch",
+                ExpressionAttributeNames={
+                    '#desc': 'Description',
+                    '#m': 'Message',
+                    '#d': 'Date',
+                    '#c': 'Count',
+                    '#r': 'RequestId',
+                    '#ch': 'Chunks'
+
+                },
+                ExpressionAttributeValues={
+                    ':desc': description,
+                    ':m': message,
+                    ':d': today.strftime('%Y%m%d'),
+                    ':c': count,
+                    ':r': requestId,
+                    ':ch': chunks
+                },
+                ReturnValues="UPDATED_NEW")
+
+        except ClientError as e:
+            self.__logger.error(e.response['Error']['Message'])
+        except Exception as e:
+            self.__logger.error(e)
+        else:
+            self.__logger.info('Analytics Saved')
+            self.__logger.info(json.dumps(response, indent=4, cls=DecimalEncoder))
+            return str(key)
+
+    def ClaimChunk(self, requestId, chunk, today):
+        # idempotency record of a chunk, AnalyticId CHUNK and RequestId/ChunkId as TransactionTime. Only the first
+        # consumer to write it gets True, False means the chunk was taken before, None that the claim failed
+        try:
+            self.__Analytics.put_item(
+                Item={
+                    'AnalyticId': 'CHUNK',
+                    'TransactionTime': '%s/%s' % (requestId, chunk),
+                    'Date': today.strftime('%Y%m%d'),
+                    'Started': str(datetime.utcnow())
+                },
+                ConditionExpression='attribute_not_exists(AnalyticId)')
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            self.__logger.error(e.response['Error']['Message'])
+        except Exception as e:
+            self.__logger.error(e)
+        return None
+
+    def GetChunk(self, requestId, chunk):
+        try:
+            response = self.__Analytics.get_item(Key={'AnalyticId': 'CHUNK',
+                                                      'TransactionTime': '%s/%s' % (requestId, chunk)},
+                                                 ConsistentRead=True)
+            return response.get('Item')
+        except ClientError as e:
+            self.__logger.error(e.response['Error']['Message'])
+        except Exception as e:
+            self.__logger.error(e)
+        return None
+
+    def UpdateChunk(self, requestId, chunk, attributes):
+        try:
+            names = dict(('#a%s' % i, name) for i, name in enumerate(attributes))
+            self.__Analytics.update_item(
+                Key={'AnalyticId': 'CHUNK', 'TransactionTime': '%s/%s' % (requestId, chunk)},
+                UpdateExpression='set %s' % ', '.join('#a%s = :a%s' % (i, i) for i in range(len(attributes))),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=dict((':a%s' % i, attributes[name])
+                                               for i, name in enumerate(attributes)))
+        except ClientError as e:
+            self.__logger.error(e.response['Error']['Message'])
+        except Exception as e:
+            self.__logger.error(e)
+
+
+class SqliteAnalytics(object):
+    # the same analytics, marks and chunk claims in an embedded database file, for single host deployments that
+    # do not want the round trips to DynamoDB. Items are kept as json with numbers read back as Decimal, like boto3
+    def __init__(self, path, logger):
+        self.__logger = logger
+        self.__lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.__db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS Analytics (AnalyticId TEXT NOT NULL, '
+                          'TransactionTime TEXT NOT NULL, RequestId TEXT, Chunks TEXT, Item TEXT NOT NULL, '
+                          'PRIMARY KEY (AnalyticId, TransactionTime)) WITHOUT ROWID')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS AnalyticsByRequest ON Analytics (RequestId, Chunks)')
+
+    @staticmethod
+    def __Load(text):
+        return json.loads(text, parse_float=decimal.Decimal, parse_int=decimal.Decimal)
+
+    @staticmethod
+    def __Row(item):
+        chunks = item.get('Chunks')
+        chunks = str(chunks) if isinstance(chunks, (str, int, decimal.Decimal)) else None
+        return (item['AnalyticId'], item['TransactionTime'], item.get('RequestId'), chunks,
+                json.dumps(item, cls=DecimalEncoder))
+
+    def __Get(self, analytic, time):
+        row = self.__db.execute('SELECT Item FROM Analytics WHERE AnalyticId = ? AND TransactionTime = ?',
+                                (analytic, time)).fetchone()
+        return self.__Load(row[0]) if row is not None else None
+
+    def __Put(self, item):
+        self.__db.execute('INSERT OR REPLACE INTO Analytics VALUES (?, ?, ?, ?, ?)', self.__Row(item))
+
+    def __Update(self, analytic, time, attributes):
+        # update_item: creates the item if needed and only sets the given attributes
+        with self.__lock:
+            self.__db.execute('BEGIN IMMEDIATE')
+            try:
+                item = self.__Get(analytic, time) or {'AnalyticId': analytic, 'TransactionTime': time}
+                item.update(attributes)
+                self.__Put(item)
+                self.__db.execute('COMMIT')
+            except BaseException:
+                self.__db.execute('ROLLBACK')
+                raise
+            return attributes
+
+    @staticmethod
+    def __Project(item, projection):
+        result = {}
+        for path in ['TransactionTime'] + projection:
+            source, target = item, result
+            names = path.split('.')
+            for name in names[:-1]:
+                if not isinstance(source, dict) or name not in source:
+                    break
+                source = source[name]
+                target = target.setdefault(name, {})
+            else:
+                if isinstance(source, dict) and names[-1] in source:
+                    target[names[-1]] = source[names[-1]]
+        return result
+
+    def GetMarks(self, fileType, ciks):
+        marks = {}
+        try:
+            ciks = [str(cik) for cik in ciks]
+            with self.__lock:
+                for i in range(0, len(ciks), 500):
+                    rows = self.__db.execute('SELECT TransactionTime, Item FROM Analytics WHERE AnalyticId = ? AND '
+                                             'TransactionTime IN (%s)' % ', '.join('?' * len(ciks[i:i + 500])),
+                                             ['MARK.%s' % fileType] + ciks[i:i + 500]).fetchall()
+                    for cik, text in rows:
+                        item = self.__Load(text)
+                        marks[cik] = {'Date': item['Date'], 'Keys': item['Keys']}
+        except Exception as e:
+            self.__logger.error(e)
+        return marks
+
+    def SaveMarks(self, fileType, marks):
+        try:
+            with self.__lock:
+                self.__db.execute('BEGIN IMMEDIATE')
+                try:
+                    for cik, mark in marks.items():
+                        self.__Put({'AnalyticId': 'MARK.%s' % fileType, 'TransactionTime': str(cik),
+                                    'Date': mark['Date'], 'Keys': mark['Keys']})
+                    self.__db.execute('COMMIT')
+                except BaseException:
+                    self.__db.execute('ROLLBACK')
+                    raise
+            self.__logger.info('Saved %s high-water marks for %s' % (len(marks), fileType))
+        except Exception as e:
+            self.__logger.error(e)
+
+    def GetAnalytics(self, analytic, date, period, projection=None, segments=1):
+        # a single local range scan of the primary key, there is nothing to gain from segments here
+        try:
+            self.__logger.info('Calling GetAnalytics query ...')
+            start, end = Period.Range(date, period)
+            with self.__lock:
+                rows = self.__db.execute('SELECT Item FROM Analytics WHERE AnalyticId = ? AND '
+                                         'TransactionTime BETWEEN ? AND ?', (analytic, str(start), str(end)))
+                items = [self.__Load(text) for text, in rows.fetchall()]
+        except Exception as e:
+            self.__logger.error(e)
+            return None
+        else:
+            if projection is not None:
+                items = [self.__Project(item, projection) for item in items]
+            return items
+
+    def UpdateAnalytics(self, action, time, processed):
+        try:
+            response = self.__Update(action, time, {'Processed': processed})
+        except Exception as e:
+            self.__logger.error(e)
+        else:
+            self.__logger.info('Analytics Updated')
+            self.__logger.info(json.dumps({'Attributes': response}, indent=4, cls=DecimalEncoder))
+
+    def SaveAnalytics(self, action, description, message, today, count, requestId, chunks):
+        try:
+            currentTime = datetime.now().time()
+            todayWithCurrentTime = datetime.combine(today, currentTime)
+            key = (todayWithCurrentTime - datetime(1970, 1, 1)).total_seconds()
+
+            response = self.__Update(action, str(key), {
+                'Description': description,
+                'Message': message,
+                'Date': today.strftime('%Y%m%d'),
+                'Count': count,
+                'RequestId': requestId,
+                'Chunks': chunks
+            })
+        except Exception as e:
+            self.__logger.error(e)
+        else:
+            self.__logger.info('Analytics Saved')
+            self.__logger.info(json.dumps({'Attributes': response}, indent=4, cls=DecimalEncoder))
+            return str(key)
+
+    def ClaimChunk(self, requestId, chunk, today):
+        try:
+            item = {
+                'AnalyticId': 'CHUNK',
+                'TransactionTime': '%s/%s' % (requestId, chunk),
+                'RequestId': requestId,
+                'Chunks': str(chunk),
+                'Date': today.strftime('%Y%m%d'),
+                'Started': str(datetime.utcnow())
+            }
+            with self.__lock:
+                cursor = self.__db.execute('INSERT OR IGNORE INTO Analytics VALUES (?, ?, ?, ?, ?)', self.__Row(item))
+            return cursor.rowcount == 1
+        except Exception as e:
+            self.__logger.error(e)
+        return None
+
+    def GetChunk(self, requestId, chunk):
+        try:
+            with self.__lock:
+                row = self.__db.execute('SELECT Item FROM Analytics WHERE RequestId = ? AND Chunks = ? AND '
+                                        'AnalyticId = ?', (requestId, str(chunk), 'CHUNK')).fetchone()
+            return self.__Load(row[0]) if row is not None else None
+        except Exception as e:
+            self.__logger.error(e)
+        return None
+
+    def UpdateChunk(self, requestId, chunk, attributes):
+        try:
+            self.__Update('CHUNK', '%s/%s' % (requestId, chunk), attributes)
+        except Exception as e:
+            self.__logger.error(e)
+
+    def Close(self):
+        with self.__lock:
+            self.__db.close()
+
 class StoreManager(object):
-    def __init__(self, logger, notify, timeout, loop=None):
+    # objects ingested between two writes of the manifest
+    MANIFEST = 50
+
+    def __init__(self, logger, notify, timeout, loop=None, workers=8, cache='/tmp/insider', layout=Layout.STREAM,
+                 backend=Backend.DYNAMODB, database='/tmp/insider/analytics.db', snapshot=None):
         self.__timeout = timeout
+        self.__workers = workers
+        self.__cache = TimeSeriesCache(cache)
+        self.__cachePath = cache
+        self.__snapshot = snapshot
         self.__notify = notify
         self.__logger = logger
         self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__layout = layout
+        self.__writers = {}
+        self.__backend = backend
+        self.__database = database
+
+    def __Writer(self, fileType):
+        if fileType not in self.__writers:
+            if self.__layout == Layout.PARTITIONED:
+                self.__writers[fileType] = PartitionWriter(self.s3.meta.client, self.__RecordType(fileType),
+                                                           self.__logger, self.__loop)
+            else:
+                self.__writers[fileType] = FirehoseWriter(self.firehose, 'Insider%s' % self.__RecordType(fileType),
+                                                          self.__logger, self.__loop)
+        return self.__writers[fileType]
+
+    @staticmethod
+    def __RecordType(fileType):
+        return 'OWNRS' if fileType == FileType.OWNER else 'CORPS'
+
+    @Metrics.timed('store.Flush')
+    async def Flush(self, fileType, ciks=None):
+        # waits until everything written so far is delivered, returns the CIKs that could not be. They are taken out
+        # of the writer, so a CIK that failed once is not held back for the life of the process, and with ciks
+        # only those are taken, a chunk running next to this one still gets its own failures
+        if fileType not in self.__writers:
+            return set()
+        writer = self.__writers[fileType]
+        await writer.Flush()
+        failed = set(writer.Failed) if ciks is None else writer.Failed.intersection(ciks)
+        writer.Failed.difference_update(failed)
+        return failed
+
+    async def Close(self):
+        for writer in self.__writers.values():
+            await writer.Close()
+        self.__writers = {}
 
     def UpdateOwnersTransactions(self, cik, items):
         try:
@@ -48,15 +1013,12 @@ class StoreManager(object):
                 all_records.append('%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s \n'
                                % (cik, ad, date, issuer.replace(',', ''), form, tran_type, di, num, total, line, i_cik,
                                   sec_name, o_type))
-            chunks = [all_records[x:x + 500] for x in range(0, len(all_records), 500)]
-            for records in chunks:
-                self.firehose.put_record_batch(
-                    DeliveryStreamName='InsiderOWNRS',
-                    Records=[{'Data': base64.b64encode(r.encode())}
-                             for r in records])
-
+            self.__Writer(FileType.OWNER).Put(all_records)
+            Metrics.Count('store.owner_rows', len(all_records))
+            return True
         except Exception as e:
             self.__logger.error(e)
+            return False
 
     def UpdateResults(self, date, items):
         try:
@@ -87,16 +1049,15 @@ class StoreManager(object):
                                   sec_name,
                                   o_type))
 
-            chunks = [all_records[x:x + 500] for x in range(0, len(all_records), 500)]
-            for records in chunks:
-                self.firehose.put_record_batch(
-                    DeliveryStreamName='InsiderCORPS',
-                    Records=[{'Data': base64.b64encode(r.encode())}
-                             for r in records])
+            self.__Writer(FileType.ISSUER).Put(all_records)
+            Metrics.Count('store.issuer_rows', len(all_records))
+            return True
         except Exception as e:
             self.__logger.error(e)
+            return False
 
-    def ReadFireHose(self, fileType, all_processed_cik, date):
+    @Metrics.timed('store.ReadFireHose')
+    def ReadFireHose(self, fileType, all_processed_cik, date, rebuild=False, since=None):
         try:
             recordType = 'CORPS'
             if fileType == FileType.ISSUER:
@@ -104,39 +1065,126 @@ class StoreManager(object):
             if fileType == FileType.OWNER:
                 recordType = 'OWNRS'
 
-            first = date.replace(day=1)
-            lastMonth = first - timedelta(days=1)
-            filterObj = '%s%04d/%02d' % (recordType, lastMonth.year, lastMonth.month)
-
-            objects = self.s3.meta.client.list_objects(Bucket='chaos-insider')
-            filtered = [i for i in objects['Contents'] if i['Key'].startswith(filterObj)]
-            for key in sorted(filtered, key=lambda k: k['LastModified']):
-                if recordType not in key['Key']:
-                    continue
-                obj = self.s3.meta.client.get_object(Bucket='chaos-insider', Key=key['Key'])
-                self.__logger.info('Processing %s' % key['Key'])
-                data = zlib.decompress(obj["Body"].read(), 32 + zlib.MAX_WBITS)
-                chunks = [data[x:x + 4] for x in range(0, len(data), 4)]
-                all_lines = ''
-                for chunk in chunks:
-                    line = base64.b64decode(chunk)
-                    all_lines += line.decode()
-                lines_list = all_lines.split('\n')
-                for cik in all_processed_cik:
-                    saved = [i for i in lines_list if i.startswith(cik)]
-                    if len(saved) > 0:
-                        with open('/tmp/%s.csv' % cik, 'w') as f:
-                            f.write('CIK,A/D,DATE,OWNER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER, OWNER CIK,SECURITY NAME,OWNER TYPE\n')
-                            for save in saved:
-                                f.write("%s\n" % save)
-                            self.__logger.info('Saving %s' % cik)
+            filterObj = recordType
+
+            if rebuild:
+                self.__logger.info('Rebuilding %s transactions cache' % fileType)
+                self.__cache.Clear(fileType)
+            # objects already ingested are skipped, so every CIK they hold has to be cached, not only the processed ones
+            manifest = self.__cache.GetManifest(fileType)
+            if len(manifest) == 0 and not rebuild and self.__snapshot:
+                manifest = self.__RestoreCache(fileType)
+            # objects only hold the rows that were new when they were written, so every month since the newest one
+            # already ingested is read up to the month being analysed, and an empty cache reads them all since since
+            if self.__layout == Layout.PARTITIONED:
+                # only the buckets of the CIKs to analyse
+                buckets = sorted(set(Layout.Bucket(cik) for cik in all_processed_cik))
+                prefixes = [prefix for bucket in buckets
+                            for prefix in self.__Months(Layout.Prefix(recordType, bucket), '%s%04d-%02d',
+                                                        manifest, since, date)]
+                filterObj = '%s buckets of %s/%s' % (len(buckets), Layout.ROOT, recordType)
+            else:
+                prefixes = self.__Months(recordType, '%s%04d/%02d', manifest, since, date)
+            paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+            filtered = [i for prefix in prefixes
+                        for page in paginator.paginate(Bucket='chaos-insider', Prefix=prefix)
+                        for i in page.get('Contents', []) if manifest.get(i['Key']) != i['ETag']]
+            keys = sorted(filtered, key=lambda k: k['LastModified'])
+            self.__logger.info('Reading %s new objects from %s for %s CIKs'
+                               % (len(keys), filterObj, len(all_processed_cik)))
+
+            # download and decode concurrently, but merge in LastModified order. The manifest is written every
+            # MANIFEST objects and at the end, a crash reads the few since again and Append drops their known rows
+            ingested = 0
+            try:
+                with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+                    window = deque()
+                    for key in keys:
+                        window.append((key, executor.submit(self.__ReadObject, key['Key'])))
+                        # every object in the window is held decoded in memory, so no more than one per worker
+                        while len(window) >= self.__workers or (key is keys[-1] and window):
+                            self.__SavePartitions(fileType, manifest, *window.popleft())
+                            ingested += 1
+                            if ingested % StoreManager.MANIFEST == 0:
+                                self.__cache.SaveManifest(fileType, manifest)
+            finally:
+                if ingested % StoreManager.MANIFEST != 0:
+                    self.__cache.SaveManifest(fileType, manifest)
+            if len(keys) > 0 and self.__snapshot:
+                self.__SnapshotCache(fileType)
         except Exception as e:
             self.__logger.error('Error: %s,Type: %s' % (e, fileType))
             return None
 
+    def __SnapshotKey(self, fileType):
+        return '%s/%s.tar.gz' % (self.__snapshot, fileType)
+
+    def __RestoreCache(self, fileType):
+        # containers start with an empty /tmp, the cache of the last run comes back from S3 instead of all history
+        path = os.path.join(self.__cachePath, '%s.tar.gz' % fileType)
+        try:
+            os.makedirs(self.__cachePath, exist_ok=True)
+            self.s3.meta.client.download_file('chaos-insider', self.__SnapshotKey(fileType), path)
+            self.__cache.Unpack(fileType, path)
+            self.__logger.info('Restored %s transactions cache from %s' % (fileType, self.__SnapshotKey(fileType)))
+        except ClientError as e:
+            self.__logger.warn('No %s transactions cache to restore: %s' % (fileType, e.response['Error']['Message']))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        return self.__cache.GetManifest(fileType)
+
+    def __SnapshotCache(self, fileType):
+        path = os.path.join(self.__cachePath, '%s.tar.gz' % fileType)
+        try:
+            self.__cache.Pack(fileType, path)
+            self.s3.meta.client.upload_file(path, 'chaos-insider', self.__SnapshotKey(fileType))
+            self.__logger.info('Saved %s transactions cache to %s' % (fileType, self.__SnapshotKey(fileType)))
+        except Exception as e:
+            self.__logger.error('Cannot save %s transactions cache: %s' % (fileType, e))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def __Months(root, pattern, manifest, since, last):
+        # CORPS2019/05/... or PARTITIONS/CORPS/07/2019-05/... keys, one prefix per month from the newest one
+        # already ingested under root up to the last one. When nothing under root was ingested yet it starts at since,
+        # or lists root itself when there is no since
+        months = [key[len(root):len(root) + 7] for key in manifest if key.startswith(root)]
+        if len(months) == 0 and since is None:
+            return [root]
+        newest = max(months) if len(months) > 0 else '%04d-%02d' % (since.year, since.month)
+        year, month = int(newest[:4]), int(newest[5:7])
+        prefixes = []
+        while (year, month) <= (last.year, last.month):
+            prefixes.append(pattern % (root, year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return prefixes if len(prefixes) > 0 else [pattern % (root, last.year, last.month)]
+
+    def __ReadObject(self, key):
+        obj = self.s3.meta.client.get_object(Bucket='chaos-insider', Key=key)
+        self.__logger.info('Processing %s' % key)
+        Metrics.Count('store.objects')
+        Metrics.Count('store.object_bytes', obj['ContentLength'])
+        partitions = {}
+        for line in streamer(obj['Body']):
+            cik = line.partition(',')[0]
+            if cik:
+                partitions.setdefault(cik, []).append(line)
+        return partitions
+
+    def __SavePartitions(self, fileType, manifest, key, future):
+        partitions = future.result()
+        count = 0
+        for cik, lines in partitions.items():
+            count += self.__cache.Append(fileType, cik, lines)
+        manifest[key['Key']] = key['ETag']
+        self.__logger.info('Saved %s new rows of %s CIKs from %s' % (count, len(partitions), key['Key']))
+
     def GetTimeSeries(self, name, fileType):
         try:
-            df = pd.read_csv('/tmp/%s.csv' % name)
+            df = self.__cache.Read(fileType, name)
             return df
         except Exception as e:
             self.__logger.error('Error: %s, Key: %s, Type: %s' % (e, name, fileType))
@@ -200,104 +1248,44 @@ class StoreManager(object):
             self.__logger.error(e)
             return None
 
-    def GetAnalytics(self, analytic, date, period):
-        try:
-            self.__logger.info('Calling GetAnalytics query ...')
-            if period == Period.DAY:
-                start = datetime(date.year, date.month, date.day, 0, 0, 0, 1)
-                start = str((start - datetime(1970, 1, 1)).total_seconds())
-                end = datetime(date.year, date.month, date.day, 23, 59, 59, 999999)
-                end = str((end - datetime(1970, 1, 1)).total_seconds())
-            if period == Period.MONTH:
-                startDate = datetime(date.year, date.month, date.day, 0, 0, 0, 1)
-                end = str((startDate - datetime(1970, 1, 1)).total_seconds())
-
-                first = startDate.replace(day=1)
-                lastMonth = first - timedelta(days=1)
-                endDate = datetime(lastMonth.year, lastMonth.month, date.day, 0, 0, 0, 1)
-                start = str((endDate - datetime(1970, 1, 1)).total_seconds())
-            response = self.__Analytics.query(
-                KeyConditionExpression=Key('AnalyticId').eq(analytic) & Key('TransactionTime').between(start, end))
-        except ClientError as e:
-            self.__logger.error(e.response['Error']['Message'])
-            return None
-        except Exception as e:
-            self.__logger.error(e)
-            return None
-        else:
-            if 'Items' in response:
-                return response['Items']
-
-    def UpdateAnalytics(self, action, time, processed):
-        try:
+    @Metrics.timed('store.GetMarks')
+    def GetMarks(self, fileType, ciks):
+        return self.__analytics.GetMarks(fileType, ciks)
 
-            response = self.__Analytics.update_item(
-                Key={
-                    'AnalyticId': action,
-                    'TransactionTime': time,
-                },
-                UpdateExpression="set #p = :p",
-                ExpressionAttributeNames={
-                    '#p': 'Processed'
+    @Metrics.timed('store.SaveMarks')
+    def SaveMarks(self, fileType, marks):
+        self.__analytics.SaveMarks(fileType, marks)
 
-                },
-                ExpressionAttributeValues={
-                    ':p': processed
-                },
-                ReturnValues="UPDATED_NEW")
+    @Metrics.timed('store.GetAnalytics')
+    def GetAnalytics(self, analytic, date, period, projection=None, segments=1):
+        return self.__analytics.GetAnalytics(analytic, date, period, projection, segments)
 
-        except ClientError as e:
-            self.__logger.error(e.response['Error']['Message'])
-        except Exception as e:
-            self.__logger.error(e)
-        else:
-            self.__logger.info('Analytics Updated')
-            self.__logger.info(json.dumps(response, indent=4, cls=DecimalEncoder))
+    @Metrics.timed('store.UpdateAnalytics')
+    def UpdateAnalytics(self, action, time, processed):
+        self.__analytics.UpdateAnalytics(action, time, processed)
 
+    @Metrics.timed('store.SaveAnalytics')
     def SaveAnalytics(self, action, description, message, today, count, requestId, chunks):
-        try:
-            # date = datetime.strptime(today, '%Y%m%d')
-            currentTime = datetime.now().time()
-            todayWithCurrentTime = datetime.combine(today, currentTime)
-            key = (todayWithCurrentTime - datetime(1970, 1, 1)).total_seconds()
-            # datetime.fromtimestamp(key)
+        return self.__analytics.SaveAnalytics(action, description, message, today, count, requestId, chunks)
 
-            response = self.__Analytics.update_item(
-                Key={
-                    'AnalyticId': action,
-                    'TransactionTime': str(key),
-                },
-                UpdateExpression="set #desc = :desc, #m = :m, #d = :d, #c = :c, #r = :r, #ch = :ch",
-                ExpressionAttributeNames={
-                    '#desc': 'Description',
-                    '#m': 'Message',
-                    '#d': 'Date',
-                    '#c': 'Count',
-                    '#r': 'RequestId',
-                    '#ch': 'Chunks'
+    @Metrics.timed('store.ClaimChunk')
+    def ClaimChunk(self, requestId, chunk, today):
+        return self.__analytics.ClaimChunk(requestId, chunk, today)
 
-                },
-                ExpressionAttributeValues={
-                    ':desc': description,
-                    ':m': message,
-                    ':d': today.strftime('%Y%m%d'),
-                    ':c': count,
-                    ':r': requestId,
-                    ':ch': chunks
-                },
-                ReturnValues="UPDATED_NEW")
+    @Metrics.timed('store.GetChunk')
+    def GetChunk(self, requestId, chunk):
+        return self.__analytics.GetChunk(requestId, chunk)
+
+    @Metrics.timed('store.UpdateChunk')
+    def UpdateChunk(self, requestId, chunk, attributes):
+        self.__analytics.UpdateChunk(requestId, chunk, attributes)
 
-        except ClientError as e:
-            self.__logger.error(e.response['Error']['Message'])
-        except Exception as e:
-            self.__logger.error(e)
-        else:
-            self.__logger.info('Analytics Saved')
-            self.__logger.info(json.dumps(response, indent=4, cls=DecimalEncoder))
 
     def __enter__(self):
-        db = boto3.resource('dynamodb', region_name='us-east-1')
-        self.__Analytics = db.Table('Insiders.Analytics')
+        if self.__backend == Backend.SQLITE:
+            self.__analytics = SqliteAnalytics(self.__database, self.__logger)
+        else:
+            self.__analytics = DynamoAnalytics(self.__logger)
         self.s3 = boto3.resource('s3')
         self.sns = boto3.client('sns')
         self.firehose = boto3.client('firehose', region_name='us-east-1')
@@ -305,4 +1293,5 @@ class StoreManager(object):
         return self
 
     def __exit__(self, *args, **kwargs):
+        self.__analytics.Close()
         self.__logger.info('StoreManager destroyed')
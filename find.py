@@ -3,7 +3,6 @@ import json
 import utils
 import logging
 import os
-import time
 import datetime
 import uuid
 import uvloop
@@ -16,14 +15,22 @@ async def main(loop, logger, today):
         params.Url = os.environ['EDGAR_URL']
         params.PageSize = os.environ['PAGE_SIZE']
         params.Timeout = int(os.environ['TIMEOUT'])
+        params.ConnectionLimit = int(os.environ['CONNECTION_LIMIT']) if 'CONNECTION_LIMIT' in os.environ else 100
+        params.HostLimit = int(os.environ['HOST_LIMIT']) if 'HOST_LIMIT' in os.environ else 20
+        params.Analytics = os.environ['ANALYTICS_BACKEND'] if 'ANALYTICS_BACKEND' in os.environ else 'DYNAMODB'
+        params.AnalyticsPath = os.environ['ANALYTICS_DB'] if 'ANALYTICS_DB' in os.environ else '/tmp/insider/analytics.db'
         delay = float(os.environ['DELAY'])
         buffer = int(os.environ['BUFFER_SIZE'])
 
         notify = ''
         trn_notify = os.environ['TRN_FOUND_ARN']
+        filings_mode = 'INGEST_MODE' in os.environ and os.environ['INGEST_MODE'] == 'FILINGS'
 
         async with Scheduler(notify, params, logger, loop) as scheduler:
             requestId = str(uuid.uuid4().hex)
+            if filings_mode:
+                await notify_filings(scheduler, logger, today, requestId, trn_notify, delay, buffer)
+                return
             cik_list = await scheduler.SyncDailyIndex(today)
             logger.info('%s CIK numbers received' % len(cik_list))
             chunks = [cik_list[x:x+buffer] for x in range(0, len(cik_list), buffer)]
@@ -34,17 +41,37 @@ async def main(loop, logger, today):
                 chunk_ids[str(i)] = chunk
             scheduler.Save({'Received': cik_list}, today, 'FOUND', len(cik_list),
                            'CIKs that reported on the day', requestId, chunk_ids)
-            i = 0
-            for chunk in chunks:
-                i += 1
-                scheduler.Notify(chunk, trn_notify, today, requestId, i)
-                time.sleep(delay)
+            failed = scheduler.NotifyAll([(chunk, requestId, i + 1, None) for i, chunk in enumerate(chunks)],
+                                         trn_notify, today, 1 / delay if delay > 0 else None)
+            if len(failed) > 0:
+                logger.error('Chunks %s of %s were not sent' % (failed, requestId))
             logger.info('%s CIK numbers sent' % len(cik_list))
 
     except Exception as e:
         logger.error(e)
 
 
+async def notify_filings(scheduler, logger, today, requestId, trn_notify, delay, buffer):
+    # chunks of filings instead of CIKs, each with the CIKs its filings are listed under
+    filings = await scheduler.SyncDailyFilings(today)
+    cik_list = sorted(set([cik for ciks in filings.values() for cik in ciks]))
+    logger.info('%s filings of %s CIK numbers received' % (len(filings), len(cik_list)))
+    names = sorted(filings)
+    chunks = [names[x:x+buffer] for x in range(0, len(names), buffer)]
+    i = 0
+    chunk_ids = {}
+    for chunk in chunks:
+        i += 1
+        chunk_ids[str(i)] = sorted(set([cik for name in chunk for cik in filings[name]]))
+    scheduler.Save({'Received': cik_list}, today, 'FOUND', len(cik_list),
+                   'CIKs that reported on the day', requestId, chunk_ids)
+    failed = scheduler.NotifyAll([(chunk_ids[str(i + 1)], requestId, i + 1, chunk) for i, chunk in enumerate(chunks)],
+                                 trn_notify, today, 1 / delay if delay > 0 else None)
+    if len(failed) > 0:
+        logger.error('Chunks %s of %s were not sent' % (failed, requestId))
+    logger.info('%s filings sent' % len(names))
+
+
 def lambda_handler(event, context):
 
     logger = logging.getLogger()
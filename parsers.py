@@ -0,0 +1,428 @@
+import bs4
+import hashlib
+import html.entities
+import html.parser
+import re
+import xml.etree.ElementTree as ElementTree
+
+
+def text(tag):
+    nxt = tag.next
+    while type(nxt) is not bs4.element.NavigableString:
+        nxt = nxt.next
+    return str(nxt)
+
+
+def row_key(row):
+    # identity of a transaction row, used by the high-water marks to recognise rows already stored
+    return hashlib.blake2b(','.join(row).encode(), digest_size=8).hexdigest()
+
+
+def lookup_owners(soup):
+    lines = [tr for table in soup.find_all('table')
+             for tr in table.children if isinstance(tr, bs4.Tag)
+             and 'Type of Owner' in tr.parent.text and len(tr.contents) == 8]
+
+    lookup = {}
+    for i in lines:
+        owner_cik = str(i.contents[2].text)
+        owner_type = str(i.contents[6].text)
+        lookup[owner_cik] = owner_type
+    return lookup
+
+
+def parse_transactions_soup(payload, start_year, mark=None):
+    # https://www.sec.gov/cgi-bin/own-disp, works for both action=getissuer and action=getowner pages
+    transactions = []
+    soup = bs4.BeautifulSoup(payload, "html.parser")
+
+    rows = [tr for table in soup.find_all('table')
+            if 'id' in table.attrs if table.attrs['id'] == 'transaction-report'
+            for tr in table.children if tr != '\n']
+
+    if len(rows) <= 1:
+        return transactions, []
+
+    owners = lookup_owners(soup)
+    for row in rows[1:]:
+        tds = list(filter(lambda x: x != '\n', row.children))
+        # A/D,DATE,OWNER/ISSUER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER,
+        # OWNER/ISSUER CIK,SECURITY NAME,OWNER TYPE
+        ad = text(tds[0])
+        date = text(tds[1])
+        if date == '-' or date.startswith(start_year):
+            return transactions, []
+        owner = text(tds[3])
+        form = text(tds[4])
+        typ = text(tds[5])
+        di = text(tds[6])
+        num = text(tds[7])
+        total = text(tds[8])
+        line = text(tds[9])
+        o_cik = text(tds[10])
+        name = text(tds[11])
+        o_type = owners[o_cik] if o_cik in owners else owner
+        row = (ad, date, owner, form, typ, di, num.replace('\n', ''), total, line, o_cik,
+               name.replace(',', ''), o_type.replace(',', ''))
+        if mark is not None:
+            # mark is (oldest date still tracked, keys of the rows stored since), anything older is already stored
+            if date < mark[0]:
+                return transactions, []
+            if row_key(row) in mark[1]:
+                continue
+        transactions.append(row)
+
+    links = [tag.attrs['onclick'] for tag in soup.find_all('input')
+             if 'type' in tag.attrs if 'button' in tag.attrs['type']
+             and 'Next' in tag.attrs['value']]
+    return transactions, links
+
+
+class OwnDispParser(html.parser.HTMLParser):
+    """Streaming extractor for own-disp pages.
+
+    Tracks only tables, their rows and cells, and the 'Next' buttons, but follows the tree building rules
+    of BeautifulSoup's html.parser builder so that it yields exactly what parse_transactions_soup yields.
+    """
+
+    VOID = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img',
+            'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer',
+            'track', 'wbr'}
+    # strings inside these are not plain NavigableStrings in bs4, so they are neither text nor cell values
+    CONTAINERS = {'rt', 'rp', 'style', 'script', 'template'}
+    PRESERVE = {'pre', 'textarea'}
+    SPACES = ' \n\t\x0c\r'
+    ENTITIES = dict([(name, chr(code)) for name, code in html.entities.name2codepoint.items()] +
+                    [(name[:-1], char) for name, char in html.entities.html5.items() if name.endswith(';')])
+    DECIMAL = re.compile('^([0-9]+)(.*)')
+    HEX = re.compile('^([0-9a-f]+)(.*)')
+
+    def __init__(self):
+        super(OwnDispParser, self).__init__(convert_charrefs=False)
+        self.stack = []
+        self.data = []
+        self.waiting = []
+        self.collectors = []
+        self.containers = []
+        self.preserve = 0
+        self.tables = []
+        self.links = []
+
+    class Node(object):
+        __slots__ = ('tag', 'attrs', 'role', 'contents', 'strings', 'next')
+
+        def __init__(self, tag, attrs, role):
+            self.tag = tag
+            self.attrs = attrs
+            self.role = role
+            self.contents = [] if role in ('table', 'row') else None
+            self.strings = [] if role in ('table', 'row', 'cell') else None
+            self.next = None
+
+        def text(self):
+            return ''.join(self.strings) if self.strings is not None else ''
+
+    class String(object):
+        __slots__ = ('value', 'plain', 'next')
+
+        def __init__(self, value, plain):
+            self.value = value
+            self.plain = plain
+            self.next = None
+
+        def text(self):
+            return self.value if self.plain else ''
+
+    def __Parent(self):
+        return self.stack[-1] if self.stack else None
+
+    def __Add(self, node):
+        parent = self.__Parent()
+        if parent is not None and parent.contents is not None:
+            parent.contents.append(node)
+
+    def __Flush(self, kind=None):
+        if not self.data:
+            return
+        value = ''.join(self.data)
+        self.data = []
+        if not self.preserve and value.strip(OwnDispParser.SPACES) == '':
+            value = '\n' if '\n' in value else ' '
+        plain = kind is None and not self.containers
+        node = OwnDispParser.String(value, plain or kind == 'cdata')
+        self.__Add(node)
+        if plain:
+            for waiting in self.waiting:
+                waiting.next = value
+            self.waiting = []
+        # like bs4, a tag's text holds the strings of its own kind: plain ones, or the script/style ones inside it
+        container = self.containers[-1] if kind is None and self.containers else None
+        for collector in self.collectors:
+            if (plain or kind == 'cdata') and collector.tag not in OwnDispParser.CONTAINERS \
+                    or container is not None and collector.tag == container:
+                collector.strings.append(value)
+        self.waiting.append(node)
+
+    def handle_starttag(self, tag, attrs):
+        self.__Flush()
+        attrs = dict((key, value if value is not None else '') for key, value in attrs)
+        parent = self.__Parent()
+        if tag == 'table':
+            role = 'table'
+        elif parent is not None and parent.role == 'table':
+            role = 'row'
+        elif parent is not None and parent.role == 'row':
+            role = 'cell'
+        else:
+            role = None
+        node = OwnDispParser.Node(tag, attrs, role)
+        self.__Add(node)
+        self.waiting.append(node)
+        if tag == 'input' and 'type' in attrs and 'button' in attrs['type'] and 'Next' in attrs['value']:
+            self.links.append(attrs['onclick'])
+        if tag in OwnDispParser.VOID:
+            return
+        self.stack.append(node)
+        if node.strings is not None:
+            self.collectors.append(node)
+        if tag in OwnDispParser.CONTAINERS:
+            self.containers.append(tag)
+        if tag in OwnDispParser.PRESERVE:
+            self.preserve += 1
+        if role == 'table':
+            self.tables.append(node)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in OwnDispParser.VOID:
+            return
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self.__Flush()
+        if not any(node.tag == tag for node in self.stack):
+            return
+        while self.stack:
+            node = self.stack.pop()
+            if node.strings is not None:
+                self.collectors.remove(node)
+            if node.tag in OwnDispParser.CONTAINERS:
+                self.containers.pop()
+            if node.tag in OwnDispParser.PRESERVE:
+                self.preserve -= 1
+            if node.tag == tag:
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_entityref(self, name):
+        self.data.append(OwnDispParser.ENTITIES.get(name, '&%s' % name))
+
+    def handle_charref(self, name):
+        base, reg = (16, OwnDispParser.HEX) if name.startswith(('x', 'X')) else (10, OwnDispParser.DECIMAL)
+        number = name[1:] if base == 16 else name
+        extra = ''
+        try:
+            code = int(number, base)
+        except ValueError:
+            match = reg.search(number)
+            code = int(match.groups()[0], base) if match is not None else None
+            extra = match.groups()[1] if match is not None else number
+        if code is not None:
+            try:
+                char = bytes([code]).decode('windows-1252') if 128 <= code <= 159 else chr(code)
+            except (UnicodeDecodeError, ValueError, OverflowError):
+                char = '\ufffd'
+            self.data.append(char)
+        self.data.append(extra)
+
+    def handle_comment(self, data):
+        self.__Flush()
+        self.data.append(data)
+        self.__Flush('comment')
+
+    def handle_decl(self, decl):
+        self.__Flush()
+        self.data.append(decl[len('DOCTYPE '):])
+        self.__Flush('decl')
+
+    def unknown_decl(self, data):
+        self.__Flush()
+        cdata = data.upper().startswith('CDATA[')
+        self.data.append(data[len('CDATA['):] if cdata else data)
+        self.__Flush('cdata' if cdata else 'decl')
+
+    def handle_pi(self, data):
+        self.__Flush()
+        self.data.append(data)
+        self.__Flush('pi')
+
+    def close(self):
+        super(OwnDispParser, self).close()
+        self.__Flush()
+        self.stack = []
+        self.collectors = []
+
+    @staticmethod
+    def value(node):
+        # bs4 GetText: the first plain string after the node in document order
+        if node.next is None:
+            raise ValueError('No text after %s' % getattr(node, 'tag', node))
+        return node.next
+
+    def Rows(self):
+        return [tr for table in self.tables if table.attrs.get('id') == 'transaction-report'
+                for tr in table.contents if not (isinstance(tr, OwnDispParser.String) and tr.value == '\n')]
+
+    def Owners(self):
+        lookup = {}
+        for table in self.tables:
+            if 'Type of Owner' not in table.text():
+                continue
+            for tr in table.contents:
+                if isinstance(tr, OwnDispParser.Node) and len(tr.contents) == 8:
+                    lookup[tr.contents[2].text()] = tr.contents[6].text()
+        return lookup
+
+
+def parse_transactions(payload, start_year, mark=None):
+    # https://www.sec.gov/cgi-bin/own-disp, works for both action=getissuer and action=getowner pages
+    transactions = []
+    parser = OwnDispParser()
+    parser.feed(payload)
+    parser.close()
+
+    rows = parser.Rows()
+    if len(rows) <= 1:
+        return transactions, []
+
+    owners = parser.Owners()
+    text = OwnDispParser.value
+    for row in rows[1:]:
+        if not isinstance(row, OwnDispParser.Node):
+            raise ValueError('Unexpected transaction row %s' % row.value)
+        tds = [td for td in row.contents if not (isinstance(td, OwnDispParser.String) and td.value == '\n')]
+        # A/D,DATE,OWNER/ISSUER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER,
+        # OWNER/ISSUER CIK,SECURITY NAME,OWNER TYPE
+        ad = text(tds[0])
+        date = text(tds[1])
+        if date == '-' or date.startswith(start_year):
+            return transactions, []
+        owner = text(tds[3])
+        form = text(tds[4])
+        typ = text(tds[5])
+        di = text(tds[6])
+        num = text(tds[7])
+        total = text(tds[8])
+        line = text(tds[9])
+        o_cik = text(tds[10])
+        name = text(tds[11])
+        o_type = owners[o_cik] if o_cik in owners else owner
+        row = (ad, date, owner, form, typ, di, num.replace('\n', ''), total, line, o_cik,
+               name.replace(',', ''), o_type.replace(',', ''))
+        if mark is not None:
+            # mark is (oldest date still tracked, keys of the rows stored since), anything older is already stored
+            if date < mark[0]:
+                return transactions, []
+            if row_key(row) in mark[1]:
+                continue
+        transactions.append(row)
+
+    return transactions, parser.links
+
+
+def parse_companies(payload, state, page_size):
+    # https://www.sec.gov/cgi-bin/browse-edgar
+    companies = []
+    soup = bs4.BeautifulSoup(payload, "html.parser")
+
+    rows = [tr for table in soup.find_all('table')
+            if 'summary' in table.attrs if 'Results' in table.attrs['summary']
+            for tr in table.children if tr != '\n']
+    for row in rows:
+        tds = list(filter(lambda x: x != '\n', row.children))
+        cik = text(tds[0])
+        name = text(tds[1])
+        if cik != 'CIK':
+            companies.append((cik, name, state))
+
+    links = [tag.attrs['onclick'] for tag in soup.find_all('input')
+             if 'type' in tag.attrs if 'button' in tag.attrs['type']
+             and 'Next %s' % page_size in tag.attrs['value']]
+    return companies, links
+
+
+# own-disp labels of the Form 4 transaction codes
+CODES = {'P': 'P-Purchase', 'S': 'S-Sale', 'V': 'V-Voluntary', 'A': 'A-Award', 'D': 'D-Return', 'F': 'F-InKind',
+         'I': 'I-Discretionary', 'M': 'M-Exempt', 'C': 'C-Conversion', 'E': 'E-ExpireShort', 'H': 'H-ExpireLong',
+         'O': 'O-OutOfTheMoney', 'X': 'X-InTheMoney', 'G': 'G-Gift', 'L': 'L-Small', 'W': 'W-Will', 'Z': 'Z-Trust',
+         'J': 'J-Other', 'K': 'K-EquitySwap', 'U': 'U-Tender'}
+
+
+def find(node, path):
+    found = node.find(path)
+    return found.text.strip() if found is not None and found.text is not None else ''
+
+
+def number(node, path):
+    value = find(node, path)
+    try:
+        return '%.4f' % float(value)
+    except ValueError:
+        return ''
+
+
+def owner_type(owner):
+    relationship = owner.find('reportingOwnerRelationship')
+    if relationship is None:
+        return ''
+    types = []
+    for tag, name in [('isDirector', 'director'), ('isOfficer', 'officer'), ('isTenPercentOwner', '10 percent owner'),
+                      ('isOther', 'other')]:
+        if find(relationship, tag) in ('1', 'true'):
+            types.append(name)
+    if 'officer' in types and find(relationship, 'officerTitle'):
+        types[types.index('officer')] = 'officer: %s' % find(relationship, 'officerTitle')
+    return ' '.join(types).replace(',', '')
+
+
+def parse_form4(payload):
+    # https://www.sec.gov/Archives/edgar/data/..., the full submission text of a Form 4 or 4/A filing
+    start = payload.find('<XML>')
+    end = payload.find('</XML>', start)
+    if start == -1 or end == -1:
+        raise ValueError('No ownership document in filing')
+    root = ElementTree.fromstring(payload[start + len('<XML>'):end].strip())
+
+    form = find(root, 'documentType')
+    issuer_cik = find(root, 'issuer/issuerCik')
+    issuer_name = find(root, 'issuer/issuerName').replace(',', '')
+    owners = [(find(owner, 'reportingOwnerId/rptOwnerCik'),
+               find(owner, 'reportingOwnerId/rptOwnerName').replace(',', ''),
+               owner_type(owner)) for owner in root.findall('reportingOwner')]
+
+    # A/D,DATE,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER,SECURITY NAME, numbered like own-disp:
+    # the non-derivative table first, then the derivative one
+    lines = []
+    for table in ['nonDerivativeTable/nonDerivativeTransaction', 'derivativeTable/derivativeTransaction']:
+        for transaction in root.findall(table):
+            lines.append((find(transaction, 'transactionAmounts/transactionAcquiredDisposedCode/value'),
+                          find(transaction, 'transactionDate/value')[:10],
+                          form,
+                          CODES.get(find(transaction, 'transactionCoding/transactionCode'),
+                                    find(transaction, 'transactionCoding/transactionCode')),
+                          '--%s' % find(transaction, 'ownershipNature/directOrIndirectOwnership/value'),
+                          number(transaction, 'transactionAmounts/transactionShares/value'),
+                          number(transaction, 'postTransactionAmounts/sharesOwnedFollowingTransaction/value'),
+                          str(len(lines) + 1),
+                          find(transaction, 'securityTitle/value').replace(',', '')))
+
+    # the same 12 fields as parse_transactions, once seen from the issuer and once from each reporting owner
+    issuer = [(ad, date, name, form, typ, di, num, total, line, o_cik, security, o_type)
+              for o_cik, name, o_type in owners
+              for ad, date, form, typ, di, num, total, line, security in lines]
+    by_owner = dict((o_cik, [(ad, date, issuer_name, form, typ, di, num, total, line, issuer_cik, security, o_type)
+                             for ad, date, form, typ, di, num, total, line, security in lines])
+                    for o_cik, name, o_type in owners)
+    return issuer_cik, issuer, by_owner
@@ -10,6 +10,7 @@ zip -g ~/insider.$1.zip check.py
 zip -g ~/insider.$1.zip companies.py
 zip -g ~/insider.$1.zip connectors.py
 zip -g ~/insider.$1.zip find.py
+zip -g ~/insider.$1.zip parsers.py
 zip -g ~/insider.$1.zip save.py
 zip -g ~/insider.$1.zip trading.py
 zip -g ~/insider.$1.zip utils.py
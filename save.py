@@ -5,44 +5,165 @@ import boto3
 import os
 import utils
 import datetime
+import functools
 import uvloop
 import warnings
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 
 from trading import EdgarParams, Scheduler, FileType
+from utils import Connection, Metrics, Profiler
+
+# seconds a received chunk stays hidden from other consumers, extended while it runs
+VISIBILITY = 900
+
+
+def get_params():
+    params = EdgarParams()
+    params.Url = os.environ['EDGAR_URL']
+    params.PageSize = os.environ['PAGE_SIZE']
+    params.Timeout = int(os.environ['TIMEOUT'])
+    params.StartYear = os.environ['START_YEAR']
+    params.Parsers = int(os.environ['PARSERS']) if 'PARSERS' in os.environ else 0
+    params.RetryBudget = int(os.environ['RETRY_BUDGET']) if 'RETRY_BUDGET' in os.environ else 200
+    params.Rate = float(os.environ['RATE']) if 'RATE' in os.environ else 10
+    params.Workers = int(os.environ['WORKERS']) if 'WORKERS' in os.environ else 20
+    params.Deadline = int(os.environ['DEADLINE']) if 'DEADLINE' in os.environ else 300
+    params.ConnectionLimit = int(os.environ['CONNECTION_LIMIT']) if 'CONNECTION_LIMIT' in os.environ else 100
+    params.HostLimit = int(os.environ['HOST_LIMIT']) if 'HOST_LIMIT' in os.environ else 20
+    params.CacheSize = int(os.environ['HTTP_CACHE_SIZE']) if 'HTTP_CACHE_SIZE' in os.environ else 256 * 1024 * 1024
+    params.Layout = os.environ['STORAGE_LAYOUT'] if 'STORAGE_LAYOUT' in os.environ else 'STREAM'
+    params.Analytics = os.environ['ANALYTICS_BACKEND'] if 'ANALYTICS_BACKEND' in os.environ else 'DYNAMODB'
+    params.AnalyticsPath = os.environ['ANALYTICS_DB'] if 'ANALYTICS_DB' in os.environ else '/tmp/insider/analytics.db'
+    params.Incremental = not ('FULL_SCRAPE' in os.environ and os.environ['FULL_SCRAPE'] == 'TRUE')
+    return params
+
+
+def get_message(body):
+    fixed_json = json.loads(body, parse_float=utils.DecimalEncoder)
+    items = fixed_json['CIK']
+    today = str(fixed_json['Date']).strip()
+    today = datetime.datetime.strptime(today, '%Y%m%d')
+    requestId = fixed_json['RequestId']
+    chunk_id = fixed_json['ChunkId']
+    filings = fixed_json['Filings'] if 'Filings' in fixed_json else None
+    return items, today, requestId, chunk_id, filings
 
 
-async def main(loop, logger, items, today, requestId, chunk_id):
+async def process(scheduler, logger, items, today, requestId, chunk_id, filings=None):
+    # one METRICS summary per chunk, whichever way it ends
+    since = Metrics.Snapshot()
     try:
-        params = EdgarParams()
-        params.Url = os.environ['EDGAR_URL']
-        params.PageSize = os.environ['PAGE_SIZE']
-        params.Timeout = int(os.environ['TIMEOUT'])
-        params.StartYear = os.environ['START_YEAR']
-
+        await sync_chunk(scheduler, logger, items, today, requestId, chunk_id, filings)
+    finally:
+        Metrics.Report(logger, 'chunk', since, RequestId=requestId, ChunkId=chunk_id, CIKs=len(items),
+                       Filings=len(filings) if filings is not None else 0)
+
+
+async def sync_chunk(scheduler, logger, items, today, requestId, chunk_id, filings=None):
+    # the bookkeeping in DynamoDB is offloaded, the other chunks on the loop do not wait for it
+    if await scheduler.Offload(scheduler.CheckIfProcessed, items, today, requestId, chunk_id, filings):
+        logger.info('Stop processing')
+        return
+
+    if filings is not None:
+        results = await scheduler.SyncFilings(filings)
+        for file_type, action in [(FileType.ISSUER, 'ISSUERS'), (FileType.OWNER, 'OWNERS')]:
+            res, stats = results[file_type]
+            await scheduler.Offload(scheduler.Save, {'Received': items, 'Processed': res, 'Codes': stats}, today,
+                                    action, len(items), 'CIKs that reported on the day', requestId, chunk_id)
+            logger.info('%s %s loaded in db reqId: %s' % (len(res), action.lower(), requestId))
+        logger.info('%s filings loaded in db' % len(filings))
+        await scheduler.Offload(scheduler.UpdateProcessed, today, requestId, chunk_id)
+        logger.info('UpdateProcessed')
+        return
+
+    res, stats = await scheduler.SyncTransactions(items, FileType.ISSUER)
+    await scheduler.Offload(scheduler.Save, {'Received': items, 'Processed': res, 'Codes': stats}, today, 'ISSUERS',
+                            len(items), 'CIKs that reported on the day and had direct purchases in the past',
+                            requestId, chunk_id)
+    logger.info('%s issuers loaded in db reqId: %s' % (len(res), requestId))
+    res, stats = await scheduler.SyncTransactions(items, FileType.OWNER)
+    await scheduler.Offload(scheduler.Save, {'Received': items, 'Processed': res, 'Codes': stats}, today, 'OWNERS',
+                            len(items), 'CIKs that reported on the day and had direct purchases in the past',
+                            requestId, chunk_id)
+    logger.info('%s owners loaded in db reqId: %s' % (len(res), requestId))
+    logger.info('%s transactions loaded in db' % len(items))
+
+    await scheduler.Offload(scheduler.UpdateProcessed, today, requestId, chunk_id)
+    logger.info('UpdateProcessed')
+
+
+async def main(loop, logger, items, today, requestId, chunk_id, filings=None):
+    try:
+        params = get_params()
         notify = ''
 
+        profiler = Profiler.FromEnvironment()
         async with Scheduler(notify, params, logger, loop) as scheduler:
-            if scheduler.CheckIfProcessed(items, today, requestId, chunk_id):
-                logger.info('Stop processing')
-                return
-
-            res, stats = await scheduler.SyncTransactions(items, FileType.ISSUER)
-            scheduler.Save({'Received': items, 'Processed': res, 'Codes': stats}, today, 'ISSUERS', len(items),
-                           'CIKs that reported on the day and had direct purchases in the past', requestId, chunk_id)
-            logger.info('%s issuers loaded in db reqId: %s' % (len(res), requestId))
-            res, stats = await scheduler.SyncTransactions(items, FileType.OWNER)
-            scheduler.Save({'Received': items, 'Processed': res, 'Codes': stats}, today, 'OWNERS', len(items),
-                           'CIKs that reported on the day and had direct purchases in the past', requestId, chunk_id)
-            logger.info('%s owners loaded in db reqId: %s' % (len(res), requestId))
-            logger.info('%s transactions loaded in db' % len(items))
-
-            scheduler.UpdateProcessed(today, requestId, chunk_id)
-            logger.info('UpdateProcessed')
+            await process(scheduler, logger, items, today, requestId, chunk_id, filings)
+        if profiler is not None:
+            profiler.Report(logger, os.environ.get('PROFILE_PATH'))
+
+    except Exception as e:
+        logger.error(e)
+
 
+async def heartbeat(loop, logger, message):
+    # keeps a chunk that is still running, or still waiting for a slot, invisible to the other consumers
+    while True:
+        await asyncio.sleep(VISIBILITY / 3)
+        try:
+            await loop.run_in_executor(None, functools.partial(message.change_visibility,
+                                                               VisibilityTimeout=VISIBILITY))
+        except Exception as e:
+            logger.error('Cannot extend visibility of %s: %s' % (message.message_id, e))
+
+
+async def consume_one(loop, logger, scheduler, slots, params, message):
+    beat = loop.create_task(heartbeat(loop, logger, message))
+    try:
+        logger.info(message.body)
+        items, today, requestId, chunk_id, filings = get_message(message.body)
+        async with slots:
+            # every chunk gets the retry budget it had when it ran in a scheduler of its own, kept in the context of
+            # its own task so the chunks running next to it keep theirs
+            Connection.Reset(params.RetryBudget)
+            await process(scheduler, logger, items, today, requestId, chunk_id, filings)
     except Exception as e:
         logger.error(e)
+    finally:
+        beat.cancel()
+    # Let the queue know that the message is processed
+    await loop.run_in_executor(None, message.delete)
+
+
+async def consume(loop, logger, queue):
+    # one scheduler, session and set of clients for the life of the process, up to CHUNKS chunks at a time
+    chunks = int(os.environ['CHUNKS']) if 'CHUNKS' in os.environ else 3
+    slots = asyncio.Semaphore(chunks)
+    running = set()
+    params = get_params()
+    profiler = Profiler.FromEnvironment()
+    async with Scheduler('', params, logger, loop) as scheduler:
+        while True:
+            # a few messages more than the slots are taken, so the next chunk starts as soon as one finishes
+            wanted = min(10, 2 * chunks - len(running))
+            if wanted <= 0:
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            messages = await loop.run_in_executor(None, functools.partial(
+                queue.receive_messages, MaxNumberOfMessages=wanted, WaitTimeSeconds=20,
+                VisibilityTimeout=VISIBILITY))
+            if not messages and not running:
+                break
+            for message in messages:
+                task = loop.create_task(consume_one(loop, logger, scheduler, slots, params, message))
+                running.add(task)
+                task.add_done_callback(running.discard)
+    Metrics.Report(logger, 'run')
+    if profiler is not None:
+        profiler.Report(logger, os.environ.get('PROFILE_PATH'))
 
 
 def lambda_handler(event, context):
@@ -57,12 +178,7 @@ def lambda_handler(event, context):
     logger.info('context %s' % context)
     fixed = event['Records'][0]['body'] if isinstance(event, dict) else event.body
     logger.info(fixed)
-    fixed_json = json.loads(fixed, parse_float=utils.DecimalEncoder)
-    items = fixed_json['CIK']
-    today = str(fixed_json['Date']).strip()
-    today = datetime.datetime.strptime(today, '%Y%m%d')
-    requestId = fixed_json['RequestId']
-    chunk_id = fixed_json['ChunkId']
+    items, today, requestId, chunk_id, filings = get_message(fixed)
 
     if 'EDGAR_URL' not in os.environ or 'PAGE_SIZE' not in os.environ or 'TIMEOUT' not in os.environ \
             or 'START_YEAR' not in os.environ:
@@ -71,7 +187,7 @@ def lambda_handler(event, context):
 
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     app_loop = asyncio.get_event_loop()
-    app_loop.run_until_complete(main(app_loop, logger, items, today, requestId, chunk_id))
+    app_loop.run_until_complete(main(app_loop, logger, items, today, requestId, chunk_id, filings))
 
     return json.dumps({'State': 'OK'})
 
@@ -86,16 +202,18 @@ if __name__ == '__main__':
 
         lambda_handler(test_event, None)
     else:
+        level = logging.DEBUG if 'LOGGING_LEVEL' in os.environ and os.environ['LOGGING_LEVEL'] == 'DEBUG' \
+            else logging.INFO
+        app_logger = logging.getLogger()
+        app_logger.setLevel(level)
+        logging.basicConfig(format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
+
         # Get the service resource
         sqs = boto3.resource('sqs')
 
         # Get the queue
         queue = sqs.get_queue_by_name(QueueName=os.environ['TRN_FOUND_ARN'])
 
-        messages = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=20, VisibilityTimeout=3600)
-        while messages:
-            for message in messages:
-                lambda_handler(message, None)
-                # Let the queue know that the message is processed
-                message.delete()
-            messages = queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=20, VisibilityTimeout=3600)
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        app_loop = asyncio.get_event_loop()
+        app_loop.run_until_complete(consume(app_loop, app_logger, queue))
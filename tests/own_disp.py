@@ -0,0 +1,71 @@
+import asyncio
+import glob
+import logging
+import os
+import sys
+import time
+sys.path.append('..')
+import parsers
+import trading
+
+# python own_disp.py [saved/own-disp-page-1.html saved/own-disp-page-2.html ...]
+# checks that the fast own-disp parser matches the BeautifulSoup one and times both per page, on the pages saved
+# under saved/ when none are given
+start_year = '2014'
+rounds = 20
+total_soup = 0
+total_fast = 0
+pages = sys.argv[1:] if len(sys.argv) > 1 else sorted(glob.glob(os.path.join('saved', 'own-disp-*.html')))
+assert len(pages) > 0, 'no own-disp pages to parse'
+for page in pages:
+    with open(page, 'r', encoding='latin-1') as f:
+        payload = f.read()
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        soup = parsers.parse_transactions_soup(payload, start_year)
+    soup_time = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        fast = parsers.parse_transactions(payload, start_year)
+    fast_time = (time.perf_counter() - start) / rounds
+
+    assert soup == fast, 'parsers disagree on %s' % page
+    # and stop at the same row when a high-water mark is given
+    if len(fast[0]) > 0:
+        mark = (fast[0][len(fast[0]) // 2][1], frozenset(parsers.row_key(row) for row in fast[0][:5]))
+        assert parsers.parse_transactions_soup(payload, start_year, mark) == \
+            parsers.parse_transactions(payload, start_year, mark), 'parsers disagree on %s with a mark' % page
+    total_soup += soup_time
+    total_fast += fast_time
+    print('%s: %s transactions, %s links, soup %.2f ms, fast %.2f ms, %.1fx'
+          % (page, len(fast[0]), len(fast[1]), soup_time * 1000, fast_time * 1000, soup_time / fast_time))
+
+if total_fast > 0:
+    print('total: soup %.2f ms, fast %.2f ms, %.1fx' % (total_soup * 1000, total_fast * 1000, total_soup / total_fast))
+
+# the saved issuer pages crawled through their Next buttons, each page fetched once and each row yielded once
+history = sorted(glob.glob(os.path.join('saved', 'own-disp-issuer-918541-*.html')))
+if len(history) > 0 and len(sys.argv) == 1:
+    payloads = {}
+    for start, page in zip(['0', '80', '160'], history):
+        with open(page, 'r', encoding='latin-1') as f:
+            payloads[start] = f.read()
+    fetched = []
+
+    async def get_page(name, cik, path, mark):
+        start = dict(parameter.split('=', 1) for parameter in path.split('&')).get('start', '0')
+        fetched.append(start)
+        return cik, parsers.parse_transactions(payloads[start], start_year, mark), [200]
+
+    async def crawl():
+        client = trading.EdgarClient(trading.EdgarParams(), logging.getLogger(), asyncio.get_event_loop())
+        client._EdgarClient__GetPage = get_page
+        return [row async for statuses, rows in client.TransactionsByCompany('918541') for row in rows]
+
+    rows = asyncio.get_event_loop().run_until_complete(crawl())
+    expected = [row for start in ['0', '80', '160'] for row in parsers.parse_transactions(payloads[start], start_year)[0]]
+    assert fetched == ['0', '80', '160'], 'pages fetched %s' % fetched
+    assert rows == expected, '%s rows crawled, %s on the pages' % (len(rows), len(expected))
+    print('crawl: %s pages fetched, %s rows' % (len(fetched), len(rows)))
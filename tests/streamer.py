@@ -0,0 +1,38 @@
+import base64
+import gzip
+import io
+import random
+import sys
+sys.path.append('..')
+import connectors
+
+# python streamer.py
+# checks that streamer gives back the same lines for raw and base64 objects whatever size the body is read in
+
+
+class Body(object):
+    # an S3 body that hands out a random number of bytes up to size, like a slow connection
+    def __init__(self, data):
+        self.__data = io.BytesIO(data)
+
+    def read(self, size):
+        return self.__data.read(random.randint(1, size))
+
+
+with open('918541.csv', 'r') as f:
+    lines = ['918541,%s' % line.rstrip('\n') for line in f.readlines()[1:]]
+text = ''.join('%s\n' % line for line in lines)
+# firehose records of up to 10 lines, each base64 encoded on its own
+records = [''.join('%s\n' % line for line in lines[i:i + 10]) for i in range(0, len(lines), 10)]
+objects = {
+    'raw': gzip.compress(text.encode()),
+    'base64': gzip.compress(b''.join(base64.b64encode(record.encode()) for record in records))
+}
+
+rounds = 50
+for name, data in objects.items():
+    for size in [1, 3, 7, 64, 1024, 64 * 1024]:
+        for i in range(rounds):
+            streamed = [line for line in connectors.streamer(Body(data), size) if line]
+            assert streamed == lines, '%s object read %s bytes at a time differs' % (name, size)
+    print('%s: %s lines, read sizes 1 to 64K, %s rounds each' % (name, len(lines), rounds))
@@ -1,14 +1,19 @@
 import aiohttp
 import asyncio
-import concurrent
+import concurrent.futures
+import functools
 import async_timeout
-import bs4
-from utils import Connection
-from connectors import StoreManager, Period, FileType
+import parsers
+from datetime import datetime, timedelta
+from utils import Connection, AdaptiveLimiter, TokenBucket, ErrorType, DecimalEncoder, Metrics
+from connectors import StoreManager, Period, FileType, HttpCache, Layout, Backend
 import time
 import socket
+import urllib.parse
 import json
+import logging
 import boto3
+import pandas as pd
 from analytics import DecisionEngine
 
 
@@ -18,6 +23,26 @@ class EdgarParams(object):
         self.PageSize = ''
         self.Timeout = 10
         self.StartYear = ''
+        self.Parsers = 0
+        self.RetryBudget = 200
+        self.Rate = 10
+        self.MinConcurrency = 2
+        self.MaxConcurrency = 20
+        self.Workers = 20
+        self.Deadline = 300
+        self.ConnectionLimit = 100
+        self.HostLimit = 20
+        self.CachePath = '/tmp/insider/http'
+        self.CacheSize = 256 * 1024 * 1024
+        self.Incremental = True
+        self.MarkLookback = 30
+        self.Layout = Layout.STREAM
+        self.Analytics = Backend.DYNAMODB
+        self.AnalyticsPath = '/tmp/insider/analytics.db'
+        # S3 prefix the transactions cache is saved to after an analysis, empty keeps it local only
+        self.CacheSnapshot = 'CACHE'
+        # months of objects read into an empty cache, 0 reads everything since StartYear
+        self.CacheLookback = 0
 
 
 class EdgarClient:
@@ -29,180 +54,157 @@ class EdgarClient:
         self.__params = params
         self.__tokens = None
         self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__limiter = AdaptiveLimiter(params.Rate, params.MinConcurrency, params.MaxConcurrency)
+        self.__pages = 0
+        self.__bytes = 0
+        self.__seconds = 0
+        self.__revalidated = 0
+        self.__cache = HttpCache(params.CachePath, params.CacheSize) if params.CacheSize > 0 else None
+
+    async def __Get(self, url):
+        # every request to sec.gov goes through the shared rate and concurrency limiter
+        status = None
+        acquired = False
+        try:
+            # Acquire gives its slot back by itself when it is cancelled, only a granted one is released here
+            await self.__limiter.Acquire()
+            acquired = True
+            start = time.time()
+            headers = self.__cache.Headers(url) if self.__cache is not None else {}
+            response = await self.__connection.get(url=url, headers=headers)
+            status = response.status
+            payload = await response.text()
+            latency = time.time() - start
+            # content length is the size on the wire, so it shows what compression saves
+            size = response.content_length if response.content_length is not None else len(payload)
+            self.__pages += 1
+            self.__bytes += size
+            self.__seconds += latency
+            Metrics.Observe('http.get', latency)
+            Metrics.Count('http.bytes', size)
+            Metrics.Count('http.status.%s' % status)
+            # the encoding lookup is skipped too unless debug messages are kept
+            if self.__logger.isEnabledFor(logging.DEBUG):
+                self.__logger.debug('GET %s Code: %s, %s bytes %s in %.3fs', url, status, size,
+                                    response.headers.get('Content-Encoding', 'identity'), latency)
+        finally:
+            if acquired:
+                self.__limiter.Release(status, time.time() - start)
+
+        if self.__cache is None:
+            return status, payload
+        if status == 304:
+            cached = self.__cache.Load(url)
+            if cached is not None:
+                self.__revalidated += 1
+                return 200, cached
+            # the body went missing since the headers were built, fetch it again without validators
+            self.__logger.warn('Cached page for %s is gone, fetching again' % url)
+            return await self.__Get(url)
+        if status == 200:
+            self.__cache.Put(url, response.headers.get('ETag'), response.headers.get('Last-Modified'), payload)
+        return status, payload
+
+    async def __Parse(self, parser, *args):
+        # timed here rather than in the parser, so the time a page waits for a free parser process counts too
+        with Metrics.Timer('parse.%s' % parser.__name__):
+            if self.__parsers is None:
+                return parser(*args)
+            return await self.__loop.run_in_executor(self.__parsers, parser, *args)
 
     @Connection.ioreliablehttp
-    async def GetTransactionsByOwner(self, cik, path=None):
-        # https://www.sec.gov/cgi-bin/own-disp
-        def LookupOwners():
-            lines = [tr for table in soup.find_all('table')
-                     for tr in table.children if isinstance(tr, bs4.Tag)
-                     and 'Type of Owner' in tr.parent.text and len(tr.contents) == 8]
-
-            lookup = {}
-            for i in lines:
-                owner_cik = str(i.contents[2].text)
-                owner_type = str(i.contents[6].text)
-                lookup[owner_cik] = owner_type
-            return lookup
-
-        def GetText(tag):
-            nxt = tag.next
-            while type(nxt) is not bs4.element.NavigableString:
-                nxt = nxt.next
-            return nxt
-
+    async def __GetPage(self, name, cik, path, mark):
+        # https://www.sec.gov/cgi-bin/own-disp, one page retried on its own, so a failure deep in the history
+        # does not throw away the pages before it
         try:
-            transactions = []
-            statuses = []
-            response = None
-            path = path if path is not None else \
-                'action=getowner&CIK=%s' % cik
+            status = None
             url = '%s/cgi-bin/own-disp?%s' % (self.__params.Url, path)
             with async_timeout.timeout(self.__timeout):
-                self.__logger.debug('Calling SearchByOwner for %s ...' % cik)
-                response = await self.__connection.get(url=url)
-                self.__logger.debug('SearchByOwner Response for %s Code: %s' % (cik, response.status))
-                if response.status != 200:
-                    self.__logger.error('Status Error GetTransactionsByOwner for %s. Response: %s' % (cik, response))
-                    return cik, None, [response.status]
-                statuses.append(response.status)
-                payload = await response.text()
+                self.__logger.debug('Calling %s for %s ...', name, cik)
+                status, payload = await self.__Get(url)
+                self.__logger.debug('%s Response for %s Code: %s', name, cik, status)
+                if status != 200:
+                    self.__logger.error('Status Error %s for %s. Response: %s' % (name, cik, status))
+                    return cik, None, [status]
                 self.__logger.debug(payload)
-                soup = bs4.BeautifulSoup(payload, "html.parser")
-
-                rows = [tr for table in soup.find_all('table')
-                        if 'id' in table.attrs if table.attrs['id'] == 'transaction-report'
-                        for tr in table.children if tr != '\n']
-
-                if len(rows) <= 1:
-                    self.__logger.info('No insider for %s' % cik)
-                    return cik, transactions, statuses
-
-                owners = LookupOwners()
-                for row in rows[1:]:
-                    tds = list(filter(lambda x: x != '\n', row.children))
-                    # A/D,DATE,ISSUER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER,
-                    # ISSUER CIK,SECURITY NAME
-                    ad = GetText(tds[0])
-                    date = GetText(tds[1])
-                    if date == '-' or date.startswith(self.__params.StartYear):
-                        return cik, transactions, statuses
-                    issuer = GetText(tds[3])
-                    form = GetText(tds[4])
-                    typ = GetText(tds[5])
-                    di = GetText(tds[6])
-                    num = GetText(tds[7])
-                    total = GetText(tds[8])
-                    line = GetText(tds[9])
-                    i_cik = GetText(tds[10])
-                    name = GetText(tds[11])
-                    o_type = owners[i_cik] if i_cik in owners else issuer
-                    transactions.append((ad, date, issuer, form, typ, di, num.replace('\n', ''), total, line, i_cik,
-                                         name.replace(',', ''), o_type.replace(',', '')))
-
-                links = (tag.attrs['onclick'] for tag in soup.find_all('input')
-                         if 'type' in tag.attrs if 'button' in tag.attrs['type']
-                         and 'Next' in tag.attrs['value'])
-                for link in links:
-                    self.__logger.debug(link)
-                    parts = link.split('?')
-                    lnk = parts[1].replace("\\", '').replace("'", '')
-                    c, more, moreStatuses = await self.GetTransactionsByOwner(cik, lnk)
-                    if more is not None:
-                        transactions.extend(more)
-                    statuses.extend(moreStatuses)
-                return cik, transactions, statuses
-        except Exception as e:
-            self.__logger.error('Error GetTransactionsByOwner for %s. Response: %s' % (cik, response))
+                # A/D,DATE,OWNER/ISSUER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER,
+                # OWNER/ISSUER CIK,SECURITY NAME,OWNER TYPE
+                page = await self.__Parse(parsers.parse_transactions, payload, self.__params.StartYear, mark)
+                return cik, page, [status]
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            self.__logger.error('Error %s for %s. Response: %s' % (name, cik, status))
             self.__logger.error(e)
             return cik, None, [500]
+        except Exception as e:
+            self.__logger.error('Parse Error %s for %s. Response: %s' % (name, cik, status))
+            self.__logger.error(e)
+            return cik, None, [Connection.parse_error]
+
+    async def __Pages(self, name, cik, path, mark):
+        # yields ([status], transactions) page by page following the Next buttons, transactions is None on a failure
+        pending = [path]
+        seen = {self.__PageKey(path)}
+        first = True
+        while pending:
+            c, page, statuses = await self.__GetPage(name, cik, pending.pop(), mark)
+            if page is None:
+                yield statuses, None
+                return
+            transactions, links = page
+            if first and len(transactions) == 0 and len(links) == 0:
+                self.__logger.info('No %s for %s' % ('insider' if mark is None else 'new transactions', cik))
+            first = False
+            yield statuses, transactions
+            for link in reversed(links):
+                self.__logger.debug('%s', link)
+                path = link.split('?')[1].replace("\\", '').replace("'", '')
+                # the Next button is at the top and the bottom of a page, each page is fetched once
+                key = self.__PageKey(path)
+                if key not in seen:
+                    seen.add(key)
+                    pending.append(path)
+
+    @staticmethod
+    def __PageKey(path):
+        # action=getissuer&CIK=918541 and action=getissuer&CIK=0000918541&type=&start=0 are the same page
+        query = dict((name, value) for name, value in urllib.parse.parse_qsl(path.strip()))
+        if 'CIK' in query and query['CIK'].isdigit():
+            query['CIK'] = str(int(query['CIK']))
+        query.setdefault('start', '0')
+        return tuple(sorted(query.items()))
+
+    # async generators of ([status], transactions) per page. mark is (oldest date still tracked, keys of the rows
+    # stored since) of a previous crawl, paging stops at rows older than it, None fetches the whole history
+    def TransactionsByOwner(self, cik, mark=None):
+        return self.__Pages('SearchByOwner', cik, 'action=getowner&CIK=%s' % cik, mark)
+
+    def TransactionsByCompany(self, cik, mark=None):
+        return self.__Pages('SearchByCIK', cik, 'action=getissuer&CIK=%s' % cik, mark)
 
     @Connection.ioreliablehttp
-    async def GetTransactionsByCompany(self, cik, path=None):
-        # https://www.sec.gov/cgi-bin/own-disp
-        def LookupOwners():
-            lines = [tr for table in soup.find_all('table')
-                     for tr in table.children if isinstance(tr, bs4.Tag)
-                     and 'Type of Owner' in tr.parent.text and len(tr.contents) == 8]
-
-            lookup = {}
-            for i in lines:
-                owner_cik = str(i.contents[2].text)
-                owner_type = str(i.contents[6].text)
-                lookup[owner_cik] = owner_type
-            return lookup
-
-        def GetText(tag):
-            nxt = tag.next
-            while type(nxt) is not bs4.element.NavigableString:
-                nxt = nxt.next
-            return nxt
-
+    async def GetFiling(self, filename):
+        # https://www.sec.gov/Archives/edgar/data/..., one request per Form 4 instead of the own-disp history
         try:
-            transactions = []
-            statuses = []
-            response = None
-            path = path if path is not None else \
-                'action=getissuer&CIK=%s' % cik
-            url = '%s/cgi-bin/own-disp?%s' % (self.__params.Url, path)
+            status = None
+            url = '%s/Archives/%s' % (self.__params.Url, filename)
             with async_timeout.timeout(self.__timeout):
-                self.__logger.debug('Calling SearchByCIK for %s ...' % cik)
-                response = await self.__connection.get(url=url)
-                self.__logger.debug('SearchByCIK Response for %s Code: %s' % (cik, response.status))
-                if response.status != 200:
-                    self.__logger.error('Status Error GetTransactionsByCompany for %s. Response: %s' % (cik, response))
-                    return cik, None, [response.status]
-                statuses.append(response.status)
-                payload = await response.text()
-                self.__logger.debug(payload)
-                soup = bs4.BeautifulSoup(payload, "html.parser")
-
-                rows = [tr for table in soup.find_all('table')
-                        if 'id' in table.attrs if table.attrs['id'] == 'transaction-report'
-                        for tr in table.children if tr != '\n']
-
-                if len(rows) <= 1:
-                    self.__logger.info('No insider for %s' % cik)
-                    return cik, transactions, statuses
-
-                owners = LookupOwners()
-                for row in rows[1:]:
-                    tds = list(filter(lambda x: x != '\n', row.children))
-                    # A/D,DATE,OWNER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER,
-                    # OWNER CIK,SECURITY NAME,OWNER TYPE
-                    ad = GetText(tds[0])
-                    date = GetText(tds[1])
-                    if date == '-' or date.startswith(self.__params.StartYear):
-                        return cik, transactions, statuses
-                    owner = GetText(tds[3])
-                    form = GetText(tds[4])
-                    typ = GetText(tds[5])
-                    di = GetText(tds[6])
-                    num = GetText(tds[7])
-                    total = GetText(tds[8])
-                    line = GetText(tds[9])
-                    o_cik = GetText(tds[10])
-                    name = GetText(tds[11])
-                    o_type = owners[o_cik] if o_cik in owners else owner
-                    transactions.append((ad, date, owner, form, typ, di, num.replace('\n', ''), total, line, o_cik,
-                                         name.replace(',', ''), o_type.replace(',', '')))
-
-                links = (tag.attrs['onclick'] for tag in soup.find_all('input')
-                         if 'type' in tag.attrs if 'button' in tag.attrs['type']
-                         and 'Next' in tag.attrs['value'])
-                for link in links:
-                    self.__logger.debug(link)
-                    parts = link.split('?')
-                    lnk = parts[1].replace("\\", '').replace("'", '')
-                    c, more, moreStatuses = await self.GetTransactionsByCompany(cik, lnk)
-                    if more is not None:
-                        transactions.extend(more)
-                    statuses.extend(moreStatuses)
-                return cik, transactions, statuses
+                self.__logger.debug('Calling GetFiling for %s ...', filename)
+                status, payload = await self.__Get(url)
+                self.__logger.debug('GetFiling Response for %s Code: %s', filename, status)
+                if status != 200:
+                    self.__logger.error('Status Error GetFiling for %s. Response: %s' % (filename, status))
+                    return filename, None, [status]
+                # ISSUER CIK, transactions by issuer, transactions by owner CIK
+                filing = await self.__Parse(parsers.parse_form4, payload)
+                return filename, filing, [status]
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            self.__logger.error('Error GetFiling for %s. Response: %s' % (filename, status))
+            self.__logger.error(e)
+            return filename, None, [500]
         except Exception as e:
-            self.__logger.error('Error GetTransactionsByCompany for %s. Response: %s' % (cik, response))
+            self.__logger.error('Parse Error GetFiling for %s. Response: %s' % (filename, status))
             self.__logger.error(e)
-            return cik, None, [500]
+            return filename, None, [Connection.parse_error]
 
     @Connection.ioreliable
     async def GetDailyIndex(self, today):
@@ -220,10 +222,9 @@ class EdgarClient:
                 quarter = 'QTR4'
             url = '%s/Archives/edgar/daily-index/%s/%s/master.%s.idx' % (self.__params.Url, y, quarter, d)
             with async_timeout.timeout(self.__timeout):
-                self.__logger.debug('Calling GetDailyIndex for %s ...' % d)
-                response = await self.__connection.get(url=url)
-                self.__logger.debug('GetDailyIndex Response for %s Code: %s' % (d, response.status))
-                payload = await response.text()
+                self.__logger.debug('Calling GetDailyIndex for %s ...', d)
+                status, payload = await self.__Get(url)
+                self.__logger.debug('GetDailyIndex Response for %s Code: %s', d, status)
                 self.__logger.info('url: %s. payload: %s' % (url, payload))
                 return payload
         except Exception as e:
@@ -233,40 +234,20 @@ class EdgarClient:
 
     @Connection.ioreliable
     async def GetCompaniesByState(self, state, path=None):
-        def GetText(tag):
-            nxt = tag.next
-            while type(nxt) is not bs4.element.NavigableString:
-                nxt = nxt.next
-            return nxt
-
         try:
-            companies = []
             path = path if path is not None else \
                 'company=&match=&filenum=&State=%s&Country=&SIC=&myowner=include&action=getcompany&count=%s' % \
                 (state, self.__params.PageSize)
             url = '%s/cgi-bin/browse-edgar?%s' % (self.__params.Url, path)
             with async_timeout.timeout(self.__timeout):
-                self.__logger.debug('Calling SearchByState for %s ...' % state)
-                response = await self.__connection.get(url=url)
-                self.__logger.debug('SearchByState Response for %s Code: %s' % (state, response.status))
-                payload = await response.text()
-                soup = bs4.BeautifulSoup(payload, "html.parser")
-
-                rows = [tr for table in soup.find_all('table')
-                        if 'summary' in table.attrs if 'Results' in table.attrs['summary']
-                        for tr in table.children if tr != '\n']
-                for row in rows:
-                    tds = list(filter(lambda x: x != '\n', row.children))
-                    cik = GetText(tds[0])
-                    name = GetText(tds[1])
-                    if cik != 'CIK':
-                        companies.append((cik, name, state))
-
-                links = (tag.attrs['onclick'] for tag in soup.find_all('input')
-                         if 'type' in tag.attrs if 'button' in tag.attrs['type']
-                         and 'Next %s' % self.__params.PageSize in tag.attrs['value'])
+                self.__logger.debug('Calling SearchByState for %s ...', state)
+                status, payload = await self.__Get(url)
+                self.__logger.debug('SearchByState Response for %s Code: %s', state, status)
+                companies, links = await self.__Parse(parsers.parse_companies, payload, state,
+                                                      self.__params.PageSize)
+
                 for link in links:
-                    self.__logger.debug(link)
+                    self.__logger.debug('%s', link)
                     parts = link.split('?')
                     more = await self.GetCompaniesByState(state, parts[1])
                     companies.extend(more)
@@ -277,17 +258,32 @@ class EdgarClient:
             return None
 
     async def __aenter__(self):
-
-        connector = aiohttp.TCPConnector(verify_ssl=False, family=socket.AF_INET, force_close=True,
-                                         limit=None, enable_cleanup_closed=True, loop=self.__loop)
-        self.__session = aiohttp.ClientSession(loop=self.__loop, connector=connector)
+        # html parsing is cpu bound, run it in worker processes so it does not stall the event loop
+        self.__parsers = concurrent.futures.ProcessPoolExecutor(max_workers=self.__params.Parsers) \
+            if self.__params.Parsers > 0 else None
+
+        # keep connections to sec.gov alive between pages instead of paying a tcp and tls handshake each time
+        connector = aiohttp.TCPConnector(verify_ssl=False, family=socket.AF_INET, keepalive_timeout=30,
+                                         limit=self.__params.ConnectionLimit,
+                                         limit_per_host=self.__params.HostLimit,
+                                         use_dns_cache=True, ttl_dns_cache=300,
+                                         enable_cleanup_closed=True, loop=self.__loop)
+        self.__session = aiohttp.ClientSession(loop=self.__loop, connector=connector,
+                                               headers={'Accept-Encoding': 'gzip, deflate'})
         self.__connection = await self.__session.__aenter__()
         self.__logger.info('Session created')
         return self
 
     async def __aexit__(self, *args, **kwargs):
+        if self.__pages > 0:
+            self.__logger.info('Fetched %s pages, %s bytes, %.3fs average latency, %s not modified'
+                               % (self.__pages, self.__bytes, self.__seconds / self.__pages, self.__revalidated))
+        if self.__cache is not None:
+            self.__cache.Save()
         await self.__connection.close()
         await self.__session.__aexit__(*args, **kwargs)
+        if self.__parsers is not None:
+            self.__parsers.shutdown()
         self.__logger.info('Session destroyed')
 
 
@@ -298,6 +294,14 @@ class Scheduler:
         self.__params = params
         self.__notify = notify
         self.__loop = loop if loop is not None else asyncio.get_event_loop()
+        self.__queues = {}
+        self.__chunks = {}
+        # DynamoDB bookkeeping runs off the event loop, so chunks sharing it keep crawling meanwhile. One thread,
+        # since the table resource is not thread safe
+        self.__bookkeeper = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='Bookkeeping')
+
+    async def Offload(self, func, *args):
+        return await self.__loop.run_in_executor(self.__bookkeeper, functools.partial(func, *args))
 
     def InvestmentFound(self, items, arn, date):
         try:
@@ -313,23 +317,76 @@ class Scheduler:
         except Exception as e:
             self.__logger.error(e)
 
-    def Notify(self, items, arn, today, requestId, chunk):
-        try:
-            message = {'Date': int(today.strftime('%Y%m%d')), 'CIK': items, 'RequestId': requestId, 'ChunkId': chunk}
+    def __Queue(self, arn):
+        if arn not in self.__queues:
+            self.__queues[arn] = self.sqs.get_queue_by_name(QueueName=arn)
+        return self.__queues[arn]
 
-            queue = self.sqs.get_queue_by_name(QueueName=arn)
-            response = queue.send_message(MessageBody=json.dumps(message))
-            '''
-            response = self.sns.publish(
-                TargetArn=arn,
-                Message=json.dumps({'default': json.dumps(message)}),
-                MessageStructure='json',
-                Subject='FOUND'
-            )
-            '''
-            self.__logger.info(response)
+    def Notify(self, items, arn, today, requestId, chunk, filings=None):
+        return self.NotifyAll([(items, requestId, chunk, filings)], arn, today)
+
+    def NotifyAll(self, chunks, arn, today, rate=None):
+        # chunks of (CIKs, RequestId, ChunkId, Filings or None), sent 10 to a call and paced at rate messages per
+        # second. Returns the ChunkIds that could not be sent
+        failed = []
+        try:
+            queue = self.__Queue(arn)
+            bucket = TokenBucket(rate, 10) if rate is not None else None
+            entries = []
+            for items, requestId, chunk, filings in chunks:
+                message = {'Date': int(today.strftime('%Y%m%d')), 'CIK': items, 'RequestId': requestId,
+                           'ChunkId': chunk}
+                if filings is not None:
+                    message['Filings'] = filings
+                entries.append((chunk, json.dumps(message, cls=DecimalEncoder)))
+
+            # at most 10 entries and 256 KiB per send_messages
+            batches = []
+            size = 0
+            for entry in entries:
+                if len(batches) == 0 or len(batches[-1]) == 10 or size + len(entry[1]) > 256 * 1024:
+                    batches.append([])
+                    size = 0
+                batches[-1].append(entry)
+                size += len(entry[1])
+
+            for batch in batches:
+                if bucket is not None:
+                    bucket.Wait(len(batch))
+                failed.extend(self.__SendBatch(queue, batch))
         except Exception as e:
             self.__logger.error(e)
+            return [chunk for items, requestId, chunk, filings in chunks]
+        self.__logger.info('Sent %s of %s chunks to %s' % (len(chunks) - len(failed), len(chunks), arn))
+        return failed
+
+    def __SendBatch(self, queue, batch):
+        # only the entries that failed on the service side are sent again
+        pending = dict((str(i), entry) for i, entry in enumerate(batch))
+        failed = []
+        tries = 0
+        while pending:
+            try:
+                response = queue.send_messages(Entries=[{'Id': key, 'MessageBody': body}
+                                                        for key, (chunk, body) in pending.items()])
+                errors = response.get('Failed', [])
+            except Exception as e:
+                self.__logger.error(e)
+                errors = [{'Id': key, 'SenderFault': False, 'Code': 'Exception', 'Message': str(e)}
+                          for key in pending]
+            retry = {}
+            for error in errors:
+                chunk, body = pending[error['Id']]
+                if error['SenderFault'] or tries >= Connection.retries:
+                    self.__logger.error('Cannot send chunk %s: %s %s' % (chunk, error['Code'], error.get('Message')))
+                    failed.append(chunk)
+                else:
+                    retry[error['Id']] = pending[error['Id']]
+            pending = retry
+            if pending:
+                tries += 1
+                time.sleep(Connection.Backoff(tries, ErrorType.THROTTLED))
+        return failed
 
     def SendError(self, message, arn):
         try:
@@ -343,15 +400,16 @@ class Scheduler:
         except Exception as e:
             self.__logger.error(e)
 
-    def AnalyseThat(self, date, arn, count):
-        issuers = self.__db.GetAnalytics('ISSUERS', date, Period.MONTH)
+    def AnalyseThat(self, date, arn, count, rebuild=False):
+        issuers = self.__db.GetAnalytics('ISSUERS', date, Period.MONTH, ['Message.Processed'], segments=4)
         if len(issuers) == 0:
             self.SendError('No ISSUERS to analyse on %s' % date.strftime('%Y-%m-%d'), arn)
             return
         all_processed_cik = list(set([cik for found in issuers for cik in found['Message']['Processed']]))
         self.__logger.info(all_processed_cik)
-        self.__db.ReadFireHose(FileType.ISSUER, all_processed_cik, date)
+        self.__db.ReadFireHose(FileType.ISSUER, all_processed_cik, date, rebuild, self.__Since(date))
         investments = []
+        frames = []
 
         for cik in all_processed_cik:
             df = self.__db.GetTimeSeries(cik, FileType.ISSUER)
@@ -360,8 +418,12 @@ class Scheduler:
                 self.__logger.error('Error: %s' % cik)
                 self.SendError('Error reading %s from S3 on %s' % (cik, date.strftime('%Y-%m-%d')), arn)
                 continue
+            df['CIK'] = cik
+            frames.append(df)
 
-            cik, pLM, pBLM, pRatio, mLM, mBLM, mRatio = self.__engine.ClusterBuying(df, date, count, cik)
+        results = self.__engine.ClusterBuyingBatch(pd.concat(frames, ignore_index=True), date, count) \
+            if len(frames) > 0 else []
+        for cik, pLM, pBLM, pRatio, mLM, mBLM, mRatio in results:
             if pLM > count:
                 self.__logger.info('investment found in %s' % cik)
                 investments.append((cik, pLM, pBLM, pRatio, mLM, mBLM, mRatio))
@@ -370,33 +432,77 @@ class Scheduler:
         if len(investments) > 0:
             self.InvestmentFound(investments, self.__notify, date)
 
+    def __Since(self, date):
+        # the oldest month of objects an empty cache is filled from
+        since = datetime(int(self.__params.StartYear), 1, 1) if self.__params.StartYear else None
+        if self.__params.CacheLookback > 0:
+            months = date.year * 12 + date.month - 1 - self.__params.CacheLookback
+            lookback = datetime(months // 12, months % 12 + 1, 1)
+            since = lookback if since is None else max(since, lookback)
+        return since
+
+    def __Saving(self, requestId, chunk_id):
+        # TransactionTime of the SAVING item of a chunk, from this process first, then from its CHUNK record
+        key = '%s/%s' % (requestId, chunk_id)
+        if self.__chunks.get(key) is None:
+            chunk = self.__db.GetChunk(requestId, chunk_id)
+            if chunk is not None and 'Saving' in chunk:
+                self.__chunks[key] = chunk['Saving']
+        return self.__chunks.get(key)
+
     def UpdateProcessed(self, today, requestId, chunk_id):
-        savings = self.__db.GetAnalytics('SAVING', today, Period.DAY)
-        for saving in savings:
-            if saving['RequestId'] == requestId and saving['Chunks'] == chunk_id:
-                self.__db.UpdateAnalytics('SAVING', saving['TransactionTime'], True)
-                self.__logger.info('Updated SAVING: %s, chunkId: %s' % (requestId, chunk_id))
-            if saving['RequestId'] == requestId and '.' in str(chunk_id) and str(chunk_id).startswith(str(saving['Chunks'])):
-                self.__db.UpdateAnalytics('SAVING', saving['TransactionTime'], True)
-                self.__logger.info('Updated parent SAVING: %s, chunkId: %s' % (requestId, saving['Chunks']))
+        # a resent chunk 3.1 also marks its parent 3 as processed
+        parts = str(chunk_id).split('.')
+        chunks = ['.'.join(parts[:i]) for i in range(len(parts), 0, -1)]
+        missing = []
+        for chunk in chunks:
+            saving = self.__Saving(requestId, chunk)
+            if saving is None:
+                missing.append(chunk)
+                continue
+            self.__db.UpdateAnalytics('SAVING', saving, True)
+            if chunk == chunks[0]:
+                self.__db.UpdateChunk(requestId, chunk, {'Processed': True})
+                self.__logger.info('Updated SAVING: %s, chunkId: %s' % (requestId, chunk))
+            else:
+                self.__logger.info('Updated parent SAVING: %s, chunkId: %s' % (requestId, chunk))
+        if len(missing) == 0:
+            return
 
-    def CheckIfProcessed(self, items, today, requestId, chunk_id):
-        savings = self.__db.GetAnalytics('SAVING', today, Period.DAY)
+        # chunks saved before they had a CHUNK record are still found the slow way
+        savings = self.__db.GetAnalytics('SAVING', today, Period.DAY, ['RequestId', 'Chunks'])
         for saving in savings:
-            if saving['RequestId'] == requestId and saving['Chunks'] == chunk_id:
-                self.__logger.info('Already processed requestId: %s, chunkId: %s' % (requestId, chunk_id))
-                return True
-
-        self.__db.SaveAnalytics('SAVING', 'Batch of CIKs to process',
-                                {'Received': items}, today, len(items), requestId, chunk_id)
+            if saving['RequestId'] == requestId and str(saving['Chunks']) in missing:
+                self.__db.UpdateAnalytics('SAVING', saving['TransactionTime'], True)
+                self.__logger.info('Updated SAVING: %s, chunkId: %s' % (requestId, saving['Chunks']))
+
+    def CheckIfProcessed(self, items, today, requestId, chunk_id, filings=None):
+        key = '%s/%s' % (requestId, chunk_id)
+        if key in self.__chunks:
+            self.__logger.info('Already processed requestId: %s, chunkId: %s' % (requestId, chunk_id))
+            return True
+        # the conditional write makes the check and the claim one step, two consumers cannot both take a chunk
+        claimed = self.__db.ClaimChunk(requestId, chunk_id, today)
+        if claimed is False:
+            self.__chunks[key] = None
+            self.__logger.info('Already processed requestId: %s, chunkId: %s' % (requestId, chunk_id))
+            return True
+
+        message = {'Received': items} if filings is None else {'Received': items, 'Filings': filings}
+        saving = self.__db.SaveAnalytics('SAVING', 'Batch of CIKs to process',
+                                         message, today, len(items), requestId, chunk_id)
+        self.__chunks[key] = saving
+        if claimed and saving is not None:
+            self.__db.UpdateChunk(requestId, chunk_id, {'Saving': saving})
         self.__logger.info('Start processing requestId: %s, chunkId: %s' % (requestId, chunk_id))
         return False
 
     def ValidateResults(self, date, arn, fix, found_arn, delay, buffer):
-        founds = self.__db.GetAnalytics('FOUND', date, Period.DAY)
-        savings = self.__db.GetAnalytics('SAVING', date, Period.DAY)
-        owners = self.__db.GetAnalytics('OWNERS', date, Period.DAY)
-        issuers = self.__db.GetAnalytics('ISSUERS', date, Period.DAY)
+        founds = self.__db.GetAnalytics('FOUND', date, Period.DAY, ['Count'])
+        savings = self.__db.GetAnalytics('SAVING', date, Period.DAY, ['RequestId', 'Chunks', 'Processed',
+                                                                        'Message.Received', 'Message.Filings'])
+        owners = self.__db.GetAnalytics('OWNERS', date, Period.DAY, ['RequestId', 'Chunks', 'Message.Codes'])
+        issuers = self.__db.GetAnalytics('ISSUERS', date, Period.DAY, ['RequestId', 'Chunks', 'Message.Codes'])
         if len(founds) == 0 or len([f for f in founds if f['Count'] == 0]):
             message = 'No FOUND events on %s' % date.strftime('%Y-%m-%d')
             self.SendError(message, arn)
@@ -419,6 +525,7 @@ class Scheduler:
                 self.SendError(message, arn)
                 self.__logger.warn(message)
 
+        resend = []
         for saving in savings:
             if 'Processed' not in saving:
                 self.__logger.info('resending %s %s on %s' % (saving['RequestId'], saving['Chunks'], date))
@@ -428,6 +535,16 @@ class Scheduler:
                               (not_processed, date.strftime('%Y-%m-%d'), saving['RequestId'], saving['Chunks'])
                     self.SendError(message, arn)
                     self.__logger.warn(message)
+                elif 'Filings' in saving['Message']:
+                    # the filings of a chunk are resent in smaller chunks, each with all the CIKs of the chunk
+                    filings = saving['Message']['Filings']
+                    chunks = [filings[x:x + buffer] for x in range(0, len(filings), buffer)]
+                    i = 0
+                    for chunk in chunks:
+                        i += 1
+                        chunk_id = '%s.%s' % (saving['Chunks'], i)
+                        resend.append(([int(x) for x in not_processed], saving['RequestId'], chunk_id, chunk))
+                        self.__logger.warn('Resending %s' % chunk)
                 else:
                     chunks = [not_processed[x:x + buffer] for x in range(0, len(not_processed), buffer)]
                     i = 0
@@ -435,13 +552,19 @@ class Scheduler:
                         i += 1
                         chunk_id = '%s.%s' % (saving['Chunks'], i)
                         chunk = [int(x) for x in chunk]
-                        self.Notify(chunk, found_arn, date, saving['RequestId'], chunk_id)
-                        time.sleep(delay)
+                        resend.append((chunk, saving['RequestId'], chunk_id, None))
                         self.__logger.warn('Resending %s' % chunk)
             else:
                 self.__logger.info('All events processed on %s for %s %s' % (date.strftime('%Y-%m-%d'),
                                                                              saving['RequestId'], saving['Chunks']))
 
+        if len(resend) > 0:
+            failed = self.NotifyAll(resend, found_arn, date, 1 / delay if delay > 0 else None)
+            if len(failed) > 0:
+                message = 'Chunks %s could not be resent on %s' % (failed, date.strftime('%Y-%m-%d'))
+                self.SendError(message, arn)
+                self.__logger.warn(message)
+
     def Save(self, message, today, action, count, desc, requestId, chunk):
         self.__db.SaveAnalytics(action, desc,
                                 message, today, count, requestId, chunk)
@@ -455,46 +578,198 @@ class Scheduler:
                 found[cells[0]] = cells[0]
         return [int(x) for x in found]
 
+    async def SyncDailyFilings(self, today):
+        # FILENAME: CIKs of the Form 4 and 4/A filings of the day, each one is listed under the issuer and every owner
+        found = {}
+        done = await self.__edgarConnection.GetDailyIndex(today)
+        for line in done.split('\n'):
+            cells = line.split('|')
+            if len(cells) == 5 and (cells[2] == '4' or cells[2] == '4/A'):
+                found.setdefault(cells[4].strip(), set()).add(int(cells[0]))
+        return dict((filename, sorted(ciks)) for filename, ciks in found.items())
+
+    def __WriteTransactions(self, cik, payload, file_type):
+        # A/D,DATE,OWNER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER, OWNER CIK,SECURITY NAME,OWNER TYPE
+        all_trans = []
+        for tran in payload:
+            ad, date, owner_issuer, form, tran_type, di, num, total, line, o_cik, sec_name, o_type = tran
+            all_trans.append((str(ad), str(date), str(owner_issuer), str(form), str(tran_type), str(di),
+                              str(num), str(total), str(line), str(o_cik), str(sec_name), str(o_type)))
+
+        saved = False
+        if file_type == FileType.ISSUER:
+            saved = self.__db.UpdateTransactions(cik, all_trans)
+        if file_type == FileType.OWNER:
+            saved = self.__db.UpdateOwnersTransactions(cik, all_trans)
+        self.__logger.info('Updated %s transactions for %s. CIK %s' % (len(all_trans), file_type, cik))
+        return saved
+
+    @staticmethod
+    def __Qualifies(payload, incremental):
+        # incremental rows are all new: the CIK passed the purchase filter before, or they come from the day's filings
+        purchases = len([date for ad, date, owner_issuer, form, tt, *o in payload if tt == 'P-Purchase'])
+        return (len(payload) > 1 and purchases > 1) or (incremental and len(payload) > 0)
+
+    def __SaveTransactions(self, cik, payload, file_type, incremental=False):
+        if payload is None:
+            return False
+        if incremental and len(payload) == 0:
+            return True
+        if self.__Qualifies(payload, incremental):
+            return self.__WriteTransactions(cik, payload, file_type)
+        return False
+
+    async def __Crawl(self, cik, file_type, mark, all_stats):
+        # pages are held back only until the CIK passes the purchase filter, after that each one is written as it
+        # arrives. Returns whether the CIK was saved and its new mark, None when it must not move
+        if file_type == FileType.ISSUER:
+            pages = self.__edgarConnection.TransactionsByCompany(cik, self.__Stop(mark))
+        if file_type == FileType.OWNER:
+            pages = self.__edgarConnection.TransactionsByOwner(cik, self.__Stop(mark))
+        buffered = []
+        streaming = False
+        saved = True
+        complete = True
+        fetched = False
+        moved = mark
+        async for status, transactions in pages:
+            all_stats.extend(status)
+            if transactions is None:
+                complete = False
+                break
+            fetched = True
+            if not streaming:
+                buffered.extend(transactions)
+                if not self.__Qualifies(buffered, mark is not None):
+                    continue
+                streaming = True
+                transactions, buffered = buffered, []
+            if len(transactions) > 0:
+                saved = self.__WriteTransactions(cik, transactions, file_type) and saved
+                moved = self.__Mark(moved, transactions)
+
+        if not fetched:
+            return False, None
+        if not streaming:
+            # nothing new for a CIK with a mark still counts, it is up to date
+            return complete and mark is not None, None
+        # a crawl cut short leaves older rows unseen, moving the mark past them would lose them for good
+        return saved, moved if saved and complete and moved is not mark else None
+
+    def __Stop(self, mark):
+        # (oldest date still tracked, keys of the rows stored since) for the parsers to stop paging at
+        if mark is None:
+            return None
+        newest = datetime.strptime(mark['Date'], '%Y-%m-%d')
+        return (newest - timedelta(days=self.__params.MarkLookback)).strftime('%Y-%m-%d'), frozenset(mark['Keys'])
+
+    def __Mark(self, mark, payload):
+        # late filings show up below newer rows, so the keys of the last MarkLookback days are kept, not only the newest
+        keys = dict(mark['Keys']) if mark is not None else {}
+        for row in payload:
+            keys[parsers.row_key(row)] = row[1]
+        dates = [date for date in keys.values() if len(date) == 10 and date[4] == '-' and date[7] == '-']
+        if len(dates) == 0:
+            return mark
+        newest = max(dates)
+        cutoff = (datetime.strptime(newest, '%Y-%m-%d') - timedelta(days=self.__params.MarkLookback)) \
+            .strftime('%Y-%m-%d')
+        return {'Date': newest, 'Keys': dict((key, date) for key, date in keys.items() if date >= cutoff)}
+
     async def SyncTransactions(self, items, file_type):
         self.__logger.info('Loaded %s: %s' % (file_type, len(items)))
 
         successful = []
         all_stats = []
-        if file_type == FileType.ISSUER:
-            futures = [self.__edgarConnection.GetTransactionsByCompany(str(cik)) for cik in items]
-        if file_type == FileType.OWNER:
-            futures = [self.__edgarConnection.GetTransactionsByOwner(str(cik)) for cik in items]
-        done, pending = await asyncio.wait(futures, timeout=self.Timeout)
+        queue = asyncio.Queue()
+        for cik in items:
+            queue.put_nowait(str(cik))
+        marks = await self.Offload(self.__db.GetMarks, file_type, [str(cik) for cik in items]) \
+            if self.__params.Incremental else {}
+        moved = {}
+        stage = 'sync.%s' % file_type.lower()
+        self.__logger.info('Loaded %s high-water marks for %s' % (len(marks), file_type))
+        deadline = self.__loop.time() + self.Timeout
+
+        async def worker():
+            while not queue.empty():
+                cik = queue.get_nowait()
+                remaining = deadline - self.__loop.time()
+                if remaining <= 0:
+                    self.__logger.error('Timeout before processing CIK %s' % cik)
+                    all_stats.append(408)
+                    continue
+                try:
+                    mark = marks.get(cik)
+                    # each CIK is written page by page as it is crawled, the slow ones do not hold back the writes
+                    with Metrics.Timer('%s.cik' % stage):
+                        saved, mark = await asyncio.wait_for(self.__Crawl(cik, file_type, mark, all_stats),
+                                                             min(self.__params.Deadline, remaining))
+                    Metrics.Count('%s.%s' % (stage, 'saved' if saved else 'skipped'))
+                    if saved:
+                        successful.append(cik)
+                    if mark is not None:
+                        moved[cik] = mark
+                except asyncio.TimeoutError:
+                    self.__logger.error('Deadline exceeded for %s CIK %s' % (file_type, cik))
+                    all_stats.append(408)
+                except Exception as e:
+                    self.__logger.error('Exception in SyncTransactions: {}'.format(e))
+
+        with Metrics.Timer('%s.crawl' % stage):
+            await asyncio.gather(*[worker() for i in range(min(self.__params.Workers, len(items)))])
+        # marks only move for CIKs whose rows reached firehose, the others are fetched in full again next time
+        failed = await self.__db.Flush(file_type, [str(cik) for cik in items])
+        await self.Offload(self.__db.SaveMarks, file_type,
+                           dict((cik, mark) for cik, mark in moved.items() if cik not in failed))
+        return successful, all_stats
 
-        for pending_task in pending:
-            self.__logger.error('Cancelling the task: {}'.format(pending_task))
-            pending_task.cancel()
+    @Metrics.timed('sync.filings')
+    async def SyncFilings(self, filings):
+        # the day's Form 4 filings, parsed from their xml and saved per issuer and per owner without any paging
+        self.__logger.info('Loaded filings: %s' % len(filings))
 
-        # A/D,DATE,OWNER,FORM,TYPE,DIRECT/INDIRECT,NUMBER,TOTAL NUMBER,LINE NUMBER, OWNER CIK,SECURITY NAME,OWNER TYPE
-        for fut in done:
-            try:
-                cik, payload, status = fut.result()
-                all_stats.extend(status)
-                if payload is not None and len(payload) > 1 \
-                        and len([date for ad, date, owner_issuer, form, tt, *o in payload if tt == 'P-Purchase']) > 1:
-                    # self.__logger.info(payload)
-                    count = 0
-                    all_trans = []
-                    for tran in payload:
-                        count += 1
-                        ad, date, owner_issuer, form, tran_type, di, num, total, line, o_cik, sec_name, o_type = tran
-                        all_trans.append((str(ad), str(date), str(owner_issuer), str(form), str(tran_type), str(di),
-                                          str(num), str(total), str(line), str(o_cik), str(sec_name), str(o_type)))
-
-                    if file_type == FileType.ISSUER:
-                        self.__db.UpdateTransactions(cik, all_trans)
-                    if file_type == FileType.OWNER:
-                        self.__db.UpdateOwnersTransactions(cik, all_trans)
-                    successful.append(cik)
-                    self.__logger.info('Updated %s transactions for %s. CIK %s' % (len(all_trans), file_type, cik))
-            except Exception as e:
-                self.__logger.error('Exception in SyncTransactions: {}'.format(e))
-        return successful, all_stats
+        issuers = {}
+        owners = {}
+        all_stats = []
+        queue = asyncio.Queue()
+        for filename in filings:
+            queue.put_nowait(filename)
+        deadline = self.__loop.time() + self.Timeout
+
+        async def worker():
+            while not queue.empty():
+                filename = queue.get_nowait()
+                remaining = deadline - self.__loop.time()
+                if remaining <= 0:
+                    self.__logger.error('Timeout before processing filing %s' % filename)
+                    all_stats.append(408)
+                    continue
+                try:
+                    filename, filing, status = await asyncio.wait_for(
+                        self.__edgarConnection.GetFiling(filename), min(self.__params.Deadline, remaining))
+                    all_stats.extend(status)
+                    if filing is None:
+                        continue
+                    issuer_cik, by_issuer, by_owner = filing
+                    issuers.setdefault(str(int(issuer_cik)), []).extend(by_issuer)
+                    for owner_cik, transactions in by_owner.items():
+                        owners.setdefault(str(int(owner_cik)), []).extend(transactions)
+                except asyncio.TimeoutError:
+                    self.__logger.error('Deadline exceeded for filing %s' % filename)
+                    all_stats.append(408)
+                except Exception as e:
+                    self.__logger.error('Exception in SyncFilings: {}'.format(e))
+
+        await asyncio.gather(*[worker() for i in range(min(self.__params.Workers, len(filings)))])
+
+        # ISSUER and OWNER results in the shape of SyncTransactions
+        results = {}
+        for file_type, found in [(FileType.ISSUER, issuers), (FileType.OWNER, owners)]:
+            successful = [cik for cik, transactions in found.items()
+                          if self.__SaveTransactions(cik, transactions, file_type, True)]
+            results[file_type] = (successful, all_stats)
+        return results
 
     async def SyncCompanies(self):
         states = self.__insiderSession.GetStates()
@@ -519,10 +794,13 @@ class Scheduler:
         self.__logger.info('Updated %s companies' % len(all_companies))
 
     async def __aenter__(self):
+        Connection.Reset(self.__params.RetryBudget)
         self.__engine = DecisionEngine(self.__notify, self.__logger)
         self.__client = EdgarClient(self.__params, self.__logger, self.__loop)
         self.__edgarConnection = await self.__client.__aenter__()
-        self.__db = StoreManager(self.__logger, self.__notify, self.Timeout)
+        self.__db = StoreManager(self.__logger, self.__notify, self.Timeout, self.__loop, layout=self.__params.Layout,
+                                 backend=self.__params.Analytics, database=self.__params.AnalyticsPath,
+                                 snapshot=self.__params.CacheSnapshot)
         self.__insiderSession = self.__db.__enter__()
         self.sns = boto3.client('sns')
         self.sqs = boto3.resource('sqs')
@@ -531,5 +809,7 @@ class Scheduler:
 
     async def __aexit__(self, *args, **kwargs):
         await self.__client.__aexit__(*args, **kwargs)
+        await self.__db.Close()
+        self.__bookkeeper.shutdown()
         self.__db.__exit__(*args, **kwargs)
         self.__logger.info('Scheduler destroyed')
@@ -1,11 +1,23 @@
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
 import decimal
+import functools
+import random
 import time
 import json
 import logging
+import os
+import queue
+import sys
+import threading
 import boto3
 import datetime
 import uuid
 import inspect
+from collections import deque
 
 
 class CloudLogger(object):
@@ -18,7 +30,13 @@ class CloudLogger(object):
     DEBUG = 10
     NOTSET = 0
 
-    def __init__(self, level):
+    # put_log_events limits, the size of an event counts its utf-8 message plus 26 bytes
+    BATCH_EVENTS = 10000
+    BATCH_BYTES = 1048576
+    EVENT_OVERHEAD = 26
+    EVENT_BYTES = 262144
+
+    def __init__(self, level, interval=5.0):
         self.__fileLogger = logging.getLogger()
         self.__fileLogger.setLevel(level)
         logging.basicConfig(format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
@@ -26,46 +44,126 @@ class CloudLogger(object):
         self.__groupName = '/aws/docker/Insider_Save'
         self.__sequenceToken = None
         self.__level = level
+        self.__interval = interval
         self.__stream = (datetime.datetime.today().strftime('%Y/%m/%d/[$LATEST]'), uuid.uuid4().hex)
         response = self.__cloudWatchLogger.create_log_stream(
             logGroupName=self.__groupName,
             logStreamName='%s%s' % self.__stream
         )
-        self.info('LogStream Created: %s' % response)
-
-    def __logToStream(self, msg):
-        if self.__sequenceToken is None:
-            response = self.__cloudWatchLogger \
-                .put_log_events(logGroupName=self.__groupName, logStreamName='%s%s' % self.__stream,
-                                logEvents=[dict(timestamp=int(round(time.time() * 1000)),
-                                                message=time.strftime("%m/%d/%Y %H:%M:%S") + msg)])
-        else:
-            response = self.__cloudWatchLogger \
-                .put_log_events(logGroupName=self.__groupName, logStreamName='%s%s' % self.__stream,
-                                logEvents=[dict(timestamp=int(round(time.time() * 1000)),
-                                                message=msg)],
-                                sequenceToken=self.__sequenceToken)
-        self.__sequenceToken = response['nextSequenceToken']
-
-    def info(self, msg):
-        if self.__level not in [CloudLogger.INFO, CloudLogger.DEBUG]: return
+        # the hot path only appends to the queue, a background thread ships the events in batches
+        self.__events = queue.Queue()
+        self.__closed = False
+        self.__shipper = threading.Thread(target=self.__Ship, name='CloudLogger', daemon=True)
+        self.__shipper.start()
+        atexit.register(self.close)
+        self.info('LogStream Created: %s', response)
+
+    def __Ship(self):
+        batch = []
+        size = 0
+        deadline = time.monotonic() + self.__interval
+        while True:
+            try:
+                event = self.__events.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                event = None
+
+            if event is not None and not isinstance(event, threading.Event):
+                length = len(event['message'].encode('utf-8')) + CloudLogger.EVENT_OVERHEAD
+                if len(batch) == CloudLogger.BATCH_EVENTS or size + length > CloudLogger.BATCH_BYTES:
+                    self.__Put(batch)
+                    batch, size = [], 0
+                batch.append(event)
+                size += length
+                continue
+
+            # the interval is up, or flush/close asked for everything queued before their marker
+            if batch:
+                self.__Put(batch)
+                batch, size = [], 0
+            deadline = time.monotonic() + self.__interval
+            if event is not None:
+                event.set()
+                if self.__closed and self.__events.empty():
+                    return
+
+    def __Put(self, batch):
+        # events from different threads can be a millisecond out of order, a batch has to be chronological
+        batch.sort(key=lambda event: event['timestamp'])
+        request = dict(logGroupName=self.__groupName, logStreamName='%s%s' % self.__stream, logEvents=batch)
+        for attempt in range(3):
+            if self.__sequenceToken is not None:
+                request['sequenceToken'] = self.__sequenceToken
+            try:
+                response = self.__cloudWatchLogger.put_log_events(**request)
+                self.__sequenceToken = response.get('nextSequenceToken')
+                return
+            except self.__cloudWatchLogger.exceptions.DataAlreadyAcceptedException as e:
+                # the batch got there before, sending it again would only duplicate the events
+                self.__sequenceToken = e.response.get('expectedSequenceToken', self.__sequenceToken)
+                return
+            except self.__cloudWatchLogger.exceptions.InvalidSequenceTokenException as e:
+                if 'expectedSequenceToken' not in e.response:
+                    break
+                self.__sequenceToken = e.response['expectedSequenceToken']
+            except Exception as e:
+                self.__fileLogger.error('Failed to ship %s log events: %s' % (len(batch), e))
+                return
+        self.__fileLogger.error('Failed to ship %s log events: sequence token rejected' % len(batch))
+
+    def __logToStream(self, level, msg):
+        message = '%s [%s] %s' % (time.strftime("%m/%d/%Y %H:%M:%S"), level, msg)
+        # no more than 4 bytes a character, only long messages can be over the event limit
+        if len(message) > CloudLogger.EVENT_BYTES // 4:
+            message = message.encode('utf-8')[:CloudLogger.EVENT_BYTES - CloudLogger.EVENT_OVERHEAD] \
+                .decode('utf-8', 'ignore')
+        self.__events.put(dict(timestamp=int(round(time.time() * 1000)), message=message))
+
+    def isEnabledFor(self, level):
+        return level >= self.__level
+
+    def flush(self, timeout=None):
+        # waits until everything logged so far has been shipped
+        if self.__closed or not self.__shipper.is_alive():
+            return
+        shipped = threading.Event()
+        self.__events.put(shipped)
+        shipped.wait(timeout)
+
+    def close(self):
+        if self.__closed or not self.__shipper.is_alive():
+            return
+        self.__closed = True
+        shipped = threading.Event()
+        self.__events.put(shipped)
+        shipped.wait(30)
+
+    # like logging, the arguments are only formatted into msg once the level lets the message through
+    def info(self, msg, *args):
+        if self.__level > CloudLogger.INFO: return
+        msg = msg % args if args else msg
         self.__fileLogger.info(msg)
-        self.__logToStream('%s [%s] %s' % (time.strftime("%m/%d/%Y %H:%M:%S"), 'INFO', msg))
+        self.__logToStream('INFO', msg)
 
-    def debug(self, msg):
-        if self.__level not in [CloudLogger.DEBUG]: return
+    def debug(self, msg, *args):
+        if self.__level > CloudLogger.DEBUG: return
+        msg = msg % args if args else msg
         self.__fileLogger.debug(msg)
-        self.__logToStream('%s [%s] %s' % (time.strftime("%m/%d/%Y %H:%M:%S"), 'DEBUG', msg))
+        self.__logToStream('DEBUG', msg)
+
+    def warn(self, msg, *args):
+        if self.__level > CloudLogger.WARN: return
+        msg = msg % args if args else msg
+        self.__fileLogger.warning(msg)
+        self.__logToStream('WARN', msg)
 
-    def warn(self, msg):
-        if self.__level not in [CloudLogger.INFO, CloudLogger.DEBUG, CloudLogger.WARN]: return
-        self.__fileLogger.warn(msg)
-        self.__logToStream('%s [%s] %s' % (time.strftime("%m/%d/%Y %H:%M:%S"), 'WARN', msg))
+    warning = warn
 
-    def error(self, msg):
-        if self.__level not in [CloudLogger.INFO, CloudLogger.DEBUG, CloudLogger.WARN, CloudLogger.ERROR]: return
+    def error(self, msg, *args):
+        if self.__level > CloudLogger.ERROR: return
+        msg = msg % args if args else msg
         self.__fileLogger.error(msg)
-        self.__logToStream('%s [%s] %s' % (time.strftime("%m/%d/%Y %H:%M:%S"), 'ERROR', msg))
+        self.__logToStream('ERROR', msg)
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -78,58 +176,388 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.__rate = float(rate)
+        self.__capacity = float(capacity if capacity is not None else rate)
+        self.__tokens = self.__capacity
+        self.__updated = time.monotonic()
+
+    def Reserve(self, tokens=1):
+        # take the tokens now, possibly going into debt, and return how long the caller has to wait
+        now = time.monotonic()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+        self.__tokens -= tokens
+        return 0 if self.__tokens >= 0 else -self.__tokens / self.__rate
+
+    async def Acquire(self, tokens=1):
+        delay = self.Reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def Wait(self, tokens=1):
+        delay = self.Reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveLimiter(object):
+    """Token bucket on the request rate plus an AIMD limit on requests in flight."""
+
+    def __init__(self, rate, minimum, maximum):
+        self.__bucket = TokenBucket(rate)
+        self.__minimum = minimum
+        self.__maximum = maximum
+        self.Limit = minimum
+        self.__inFlight = 0
+        self.__successes = 0
+        self.__waiters = deque()
+        self.__latency = None
+        self.__baseline = None
+
+    async def Acquire(self):
+        while self.__inFlight >= self.Limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self.__waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                self.__Wake()
+                raise
+        self.__inFlight += 1
+        try:
+            await self.__bucket.Acquire()
+        except asyncio.CancelledError:
+            # a deadline that expires while waiting for a token must not keep the slot
+            self.__inFlight -= 1
+            self.__Wake()
+            raise
+
+    def Release(self, status, latency):
+        self.__inFlight -= 1
+        self.__latency = latency if self.__latency is None else 0.8 * self.__latency + 0.2 * latency
+        # slowly forgetting minimum, so one very fast response does not pin the baseline forever
+        self.__baseline = self.__latency if self.__baseline is None else min(self.__baseline * 1.01, self.__latency)
+
+        if status in Connection.throttled:
+            # multiplicative decrease when sec.gov pushes back
+            self.Limit = max(self.__minimum, self.Limit // 2)
+            self.__successes = 0
+        elif status not in (200, 304) or self.__latency > 2 * self.__baseline:
+            self.Limit = max(self.__minimum, self.Limit - 1)
+            self.__successes = 0
+        else:
+            # additive increase after a full window of good responses
+            self.__successes += 1
+            if self.__successes >= self.Limit:
+                self.Limit = min(self.__maximum, self.Limit + 1)
+                self.__successes = 0
+        self.__Wake()
+
+    def __Wake(self):
+        free = self.Limit - self.__inFlight
+        while free > 0 and self.__waiters:
+            waiter = self.__waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class ErrorType(object):
+    THROTTLED = 'THROTTLED'
+    SERVER = 'SERVER'
+    CLIENT = 'CLIENT'
+    PARSE = 'PARSE'
+    UNKNOWN = 'UNKNOWN'
+
+
 class Connection(object):
     retries = 5
+    budget = 200
+    base = 1
+    cap = 30
+    throttled = [403, 429]
+    parse_error = 'PARSE'
 
     def __init__(self):
         pass
 
+    # retries left of the chunk or run being processed. The holder is kept in the context of whoever reset it, so
+    # the tasks it starts share it, and a chunk running next to it that resets its own does not refill it
+    remaining = contextvars.ContextVar('remaining', default=None)
+
+    @staticmethod
+    def Reset(budget):
+        # retries allowed in total for the chunk or run, shared by every decorated call it makes
+        Connection.remaining.set([budget])
+
+    @staticmethod
+    def Spend():
+        holder = Connection.remaining.get()
+        if holder is None:
+            # threads of an executor do not see the context, they spend from the budget of the process
+            if Connection.budget <= 0:
+                return False
+            Connection.budget -= 1
+            return True
+        if holder[0] <= 0:
+            return False
+        holder[0] -= 1
+        return True
+
+    @staticmethod
+    def Classify(statuses):
+        if any(status in Connection.throttled for status in statuses):
+            return ErrorType.THROTTLED
+        if any(isinstance(status, int) and status >= 500 for status in statuses):
+            return ErrorType.SERVER
+        if Connection.parse_error in statuses:
+            return ErrorType.PARSE
+        if any(isinstance(status, int) and 400 <= status < 500 for status in statuses):
+            return ErrorType.CLIENT
+        return ErrorType.UNKNOWN
+
+    @staticmethod
+    def Retryable(error):
+        return error in [ErrorType.THROTTLED, ErrorType.SERVER, ErrorType.UNKNOWN]
+
+    @staticmethod
+    def Backoff(tries, error):
+        ceiling = min(Connection.cap, Connection.base * 2 ** tries)
+        if error == ErrorType.THROTTLED:
+            # throttled by the server, always give it at least half of the window
+            return ceiling / 2 + random.uniform(0, ceiling / 2)
+        return random.uniform(0, ceiling)
+
     @staticmethod
     def ioreliablehttp(func):
+        def failed(result):
+            if result is None:
+                return ErrorType.UNKNOWN
+            cik, payload, statuses = result
+            if payload is None or (len(statuses) == 1 and statuses != [200]):
+                return Connection.Classify(statuses)
+            return None
+
+        @functools.wraps(func)
         async def _decorator(self, *args, **kwargs):
             tries = 0
             result = await func(self, *args, **kwargs)
-            check = result is None or (isinstance(result, tuple) and None in result) or \
-                    (len(result[2]) == 1 and result[2] != [200])
-
-            if check:
-                while check and tries < Connection.retries:
-                    tries += 1
-                    time.sleep(2 ** tries)
-                    result = await func(self, *args, **kwargs)
-                    check = result is None or (isinstance(result, tuple) and None in result) or \
-                            (len(result[2]) == 1 and result[2] != [200])
+            error = failed(result)
+            while error is not None and Connection.Retryable(error) and tries < Connection.retries \
+                    and Connection.Spend():
+                tries += 1
+                await asyncio.sleep(Connection.Backoff(tries, error))
+                result = await func(self, *args, **kwargs)
+                error = failed(result)
             return result
 
         return _decorator
 
     @staticmethod
     def ioreliable(func):
+        def failed(result):
+            if result is None or (isinstance(result, tuple) and None in result):
+                return ErrorType.UNKNOWN
+            return None
+
+        @functools.wraps(func)
         async def _decorator(self, *args, **kwargs):
             tries = 0
             result = await func(self, *args, **kwargs)
-            check = result is None or (isinstance(result, tuple) and None in result)
-
-            if check:
-                while check and tries < Connection.retries:
-                    tries += 1
-                    time.sleep(2 ** tries)
-                    result = await func(self, *args, **kwargs)
-                    check = result is None or (isinstance(result, tuple) and None in result)
+            error = failed(result)
+            while error is not None and tries < Connection.retries and Connection.Spend():
+                tries += 1
+                await asyncio.sleep(Connection.Backoff(tries, error))
+                result = await func(self, *args, **kwargs)
+                error = failed(result)
             return result
 
         return _decorator
 
     @staticmethod
     def reliable(func):
+        if asyncio.iscoroutinefunction(func):
+            return Connection.ioreliable(func)
+
+        @functools.wraps(func)
         def _decorator(self, *args, **kwargs):
             tries = 0
             result = func(self, *args, **kwargs)
-            if result is None:
-                while result is None and tries < Connection.retries:
-                    tries += 1
-                    time.sleep(2 ** tries)
-                    result = func(self, *args, **kwargs)
+            while result is None and tries < Connection.retries and Connection.Spend():
+                tries += 1
+                time.sleep(Connection.Backoff(tries, ErrorType.UNKNOWN))
+                result = func(self, *args, **kwargs)
             return result
 
         return _decorator
+
+
+class Metrics(object):
+    # process wide counters and latency histograms, cheap enough for the hot path. A summary is the difference
+    # between two snapshots, so a chunk reports what happened while it ran, work of chunks running next to it included
+    BOUNDS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')]
+    counters = {}
+    timers = {}
+    lock = threading.Lock()
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def Count(name, value=1):
+        with Metrics.lock:
+            Metrics.counters[name] = Metrics.counters.get(name, 0) + value
+
+    @staticmethod
+    def Observe(name, seconds):
+        # timer is [count, total seconds, max seconds, one bucket per bound]
+        with Metrics.lock:
+            timer = Metrics.timers.get(name)
+            if timer is None:
+                timer = Metrics.timers[name] = [0, 0.0, 0.0] + [0] * len(Metrics.BOUNDS)
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            timer[3 + bisect.bisect_left(Metrics.BOUNDS, seconds)] += 1
+
+    @staticmethod
+    @contextlib.contextmanager
+    def Timer(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Metrics.Observe(name, time.perf_counter() - start)
+
+    @staticmethod
+    def timed(name):
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def _decorator(*args, **kwargs):
+                    with Metrics.Timer(name):
+                        return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def _decorator(*args, **kwargs):
+                    with Metrics.Timer(name):
+                        return func(*args, **kwargs)
+            return _decorator
+
+        return decorator
+
+    @staticmethod
+    def Snapshot():
+        with Metrics.lock:
+            return dict(Metrics.counters), dict((name, list(timer)) for name, timer in Metrics.timers.items())
+
+    @staticmethod
+    def __Percentile(buckets, count, percentile):
+        # upper bound of the bucket the percentile falls in
+        seen = 0
+        for bound, bucket in zip(Metrics.BOUNDS, buckets):
+            seen += bucket
+            if seen >= percentile * count:
+                return bound
+        return Metrics.BOUNDS[-1]
+
+    @staticmethod
+    def Summary(since=None):
+        counters, timers = Metrics.Snapshot()
+        before_counters, before_timers = since if since is not None else ({}, {})
+        summary = {'Counters': {}, 'Timers': {}}
+        for name, value in sorted(counters.items()):
+            value -= before_counters.get(name, 0)
+            if value != 0:
+                summary['Counters'][name] = value
+        for name, timer in sorted(timers.items()):
+            before = before_timers.get(name)
+            count = timer[0] - (before[0] if before is not None else 0)
+            if count == 0:
+                continue
+            total = timer[1] - (before[1] if before is not None else 0)
+            buckets = [now - (before[3 + i] if before is not None else 0) for i, now in enumerate(timer[3:])]
+            # max is not additive, the one of the whole process is the best there is
+            summary['Timers'][name] = {'Count': count, 'Total': round(total, 3), 'Mean': round(total / count, 4),
+                                       'Max': round(timer[2], 4),
+                                       'P50': Metrics.__Percentile(buckets, count, 0.5),
+                                       'P90': Metrics.__Percentile(buckets, count, 0.9),
+                                       'P99': Metrics.__Percentile(buckets, count, 0.99)}
+        return summary
+
+    @staticmethod
+    def Report(logger, scope, since=None, **context):
+        # one json line per chunk or run, METRICS prefixed so it is easy to pick out of the log stream
+        summary = Metrics.Summary(since)
+        summary['Scope'] = scope
+        summary.update(context)
+        logger.info('METRICS %s' % json.dumps(summary, cls=DecimalEncoder, default=str))
+        return summary
+
+
+class Profiler(object):
+    # samples the stack of every other thread on a timer, nothing has to be instrumented for it. The samples are
+    # kept as folded stacks, the input of flamegraph.pl and speedscope
+    def __init__(self, interval=0.005, depth=64):
+        self.__interval = interval
+        self.__depth = depth
+        self.__stacks = {}
+        self.__samples = 0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    @staticmethod
+    def FromEnvironment():
+        # PROFILE_INTERVAL in milliseconds switches it on
+        if 'PROFILE_INTERVAL' not in os.environ:
+            return None
+        profiler = Profiler(float(os.environ['PROFILE_INTERVAL']) / 1000)
+        profiler.Start()
+        return profiler
+
+    def Start(self):
+        self.__thread = threading.Thread(target=self.__Run, name='Profiler', daemon=True)
+        self.__thread.start()
+
+    def __Run(self):
+        me = threading.get_ident()
+        while not self.__stop.wait(self.__interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.__depth:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.__stacks[key] = self.__stacks.get(key, 0) + 1
+            self.__samples += 1
+
+    def Stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def Top(self, count=20):
+        # functions that were running when sampled, the self time of a profile
+        leaves = {}
+        for stack, samples in self.__stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + samples
+        return sorted(leaves.items(), key=lambda leaf: leaf[1], reverse=True)[:count]
+
+    def Save(self, path):
+        with open(path, 'w') as f:
+            for stack, samples in self.__stacks.items():
+                f.write('%s %s\n' % (stack, samples))
+
+    def Report(self, logger, path=None):
+        self.Stop()
+        logger.info('PROFILE %s samples every %.1f ms, top: %s'
+                    % (self.__samples, self.__interval * 1000, json.dumps(self.Top())))
+        if path is not None:
+            self.Save(path)
+            logger.info('PROFILE folded stacks saved to %s' % path)